@@ -17,6 +17,10 @@ $stderr.sync = true
 require 'net/http'
 require 'uri'
 require 'optparse'
+require 'fileutils'
+require 'digest/sha1'
+require 'zlib'
+require 'stringio'
 
 BUILDER_ROOT = File.expand_path(File.dirname(__FILE__))
 Dir.chdir BUILDER_ROOT
@@ -75,6 +79,7 @@ class Config
   attr_accessor :server_host, :builder_name
   attr_accessor :poll_interval, :poll_interval_overriden
   attr_accessor :automatic_updates
+  attr_accessor :pool, :tags
 end
 config = Config.new
 config.server_host = "builder.yoursway.com"
@@ -83,6 +88,8 @@ config.builder_name = ENV['BUILDER_NAME'] unless (ENV['BUILDER_NAME'] || '').emp
 config.poll_interval = 59 # a default, will be overridden from the server
 config.poll_interval_overriden = false
 config.automatic_updates = (ENV['BUILDER_SELFUPDATE'] || 'false') == 'true'
+config.pool = ENV['BUILDER_POOL'] || 'default'
+config.tags = (ENV['BUILDER_TAGS'] || '').split(',')
 
 OptionParser.new do |opts|
   opts.banner = "Usage: ruby worker.rb [options]"
@@ -95,6 +102,14 @@ OptionParser.new do |opts|
     config.builder_name = opt
   end
 
+  opts.on("--pool POOL", String, "the pool of builders to take work from (default: default)" ) do |opt|
+    config.pool = opt
+  end
+
+  opts.on("--tags TAGS", String, "comma-separated capabilities of this builder (e.g. mac,xcode)" ) do |opt|
+    config.tags = opt.split(',')
+  end
+
   opts.on_tail("--default-poll SECONDS", Integer, "default poll interval (used only if the server is not reachable)") do |val|
     config.poll_interval = val
   end
@@ -125,6 +140,8 @@ puts "YourSway Builder build host"
 puts
 puts "Server:              #{config.server_host}"
 puts "Builder name:        #{config.builder_name}"
+puts "Pool:                #{config.pool}"
+puts "Tags:                #{config.tags.join(', ')}" unless config.tags.empty?
 puts "Builder version:     #{ENV['BUILDER_VERSION']}" if ENV['BUILDER_VERSION']
 puts "Fixed poll interval: #{config.poll_interval} seconds" if config.poll_interval_overriden
 puts "Automatic updates:   enabled" if config.automatic_updates
@@ -141,16 +158,31 @@ class ServerCommunication
   
   attr_writer :retry_interval
   
-  def initialize feedback, server_host, builder_name, retry_interval
+  def initialize feedback, server_host, builder_name, retry_interval, pool, tags
     @builder_name = builder_name
+    @pool = pool
+    @tags = tags
     @server_host = server_host
     @obtain_work_uri = URI.parse("http://#{@server_host}/builders/#{@builder_name}/obtain-work")
     @retry_interval = retry_interval
   end
   
+  # seconds the server may hold an obtain-work request open waiting for a job
+  LONG_POLL_WAIT = 20
+  
   def obtain_work
     post "Asking #{@server_host} to provide new jobs...",
-      @obtain_work_uri, 'token' => 42
+      @obtain_work_uri, 'token' => 42, 'wait' => LONG_POLL_WAIT, 'pool' => @pool, 'tags' => @tags.join(','),
+      'includes' => 1
+  end
+  
+  def fetch_script script_hash
+    network_operation "Downloading script #{script_hash} from #{@server_host}..." do
+      uri = URI.parse("http://#{@server_host}/scripts/#{script_hash}")
+      request = Net::HTTP::Get.new(uri.path)
+      request['Accept-Encoding'] = 'gzip'
+      Net::HTTP.start(uri.host, uri.port) { |http| http.request(request) }
+    end
   end
   
   def job_done message_id, data
@@ -158,10 +190,24 @@ class ServerCommunication
       message_done_uri(message_id), data.merge('token' => 42)
   end
   
+  # returns false if the records could not be delivered
+  def send_report message_id, seq, records
+    begin
+      body = try_network_operation do
+        compressed_post_form message_report_uri(message_id), 'seq' => seq, 'records' => records, 'token' => 42
+      end
+      raise BuildAborted.new if body == "ABORT"
+      true
+    rescue NetworkError => e
+      puts "#{e.message}, will send the whole report at the end instead."
+      false
+    end
+  end
+  
   def send_console message_id, data
     begin
       body = try_network_operation do
-        Net::HTTP.post_form message_progress_uri(message_id), 'console' => data
+        compressed_post_form message_progress_uri(message_id), 'append' => data
       end
       raise BuildAborted.new if body == "ABORT"
     rescue NetworkError => e
@@ -175,13 +221,44 @@ private
     URI.parse("http://#{@server_host}/messages/%s/report_progress" % message_id)
   end
 
+  def message_report_uri(message_id)
+    URI.parse("http://#{@server_host}/builders/#{@builder_name}/messages/%s/report" % message_id)
+  end
+
   def message_done_uri(message_id)
     URI.parse("http://#{@server_host}/builders/#{@builder_name}/messages/%s/done" % message_id)
   end
 
   def post(message, uri, vars = {})
     network_operation(message) do
-      Net::HTTP.post_form(uri, vars)
+      compressed_post_form(uri, vars)
+    end
+  end
+
+  # bodies smaller than this are sent as is
+  MIN_COMPRESSED_SIZE = 512
+
+  # like Net::HTTP.post_form, but gzips large bodies and asks for a gzipped response
+  def compressed_post_form uri, vars
+    request = Net::HTTP::Post.new(uri.path)
+    request.set_form_data(vars)
+    if request.body.length >= MIN_COMPRESSED_SIZE
+      buffer = StringIO.new
+      gz = Zlib::GzipWriter.new(buffer)
+      gz.write request.body
+      gz.close
+      request.body = buffer.string
+      request['Content-Encoding'] = 'gzip'
+    end
+    request['Accept-Encoding'] = 'gzip'
+    Net::HTTP.start(uri.host, uri.port) { |http| http.request(request) }
+  end
+
+  def decoded_body response
+    if response['Content-Encoding'] == 'gzip'
+      Zlib::GzipReader.new(StringIO.new(response.body)).read
+    else
+      response.body
     end
   end
 
@@ -200,7 +277,7 @@ private
   def try_network_operation
     begin
       response = yield
-      return response.body if (200...300) === response.code.to_i
+      return decoded_body(response) if (200...300) === response.code.to_i
       raise NetworkError, "Server returned error response #{response.code}"
     rescue Errno::ECONNREFUSED => e
       raise NetworkError, "Connection refused: #{e}" 
@@ -223,6 +300,40 @@ private
   
 end
 
+# scripts are referred to from envelopes by the SHA-1 of their text and never change,
+# so each one is downloaded only once
+class ScriptCache
+  
+  INCLUDE_PREFIX = "INCLUDE\t"
+  
+  def initialize communicator, dir
+    @communicator = communicator
+    @dir = dir
+  end
+  
+  def expand_includes lines
+    lines.collect do |line|
+      if line.start_with?(INCLUDE_PREFIX)
+        script(line[INCLUDE_PREFIX.length..-1].strip).split("\n")
+      else
+        line
+      end
+    end.flatten
+  end
+  
+  def script script_hash
+    file = File.join(@dir, script_hash)
+    return File.read(file) if File.exists?(file)
+    text = @communicator.fetch_script(script_hash)
+    raise "Script #{script_hash} got corrupted on the way" unless Digest::SHA1.hexdigest(text) == script_hash
+    FileUtils.mkdir_p @dir
+    File.open("#{file}.tmp", 'w') { |f| f.write text }
+    File.rename "#{file}.tmp", file
+    text
+  end
+  
+end
+
 class ConsoleFeedback
   
   def initialize
@@ -358,7 +469,7 @@ class NetworkFeedback
   
   def initialize communicator
     @communicator = communicator
-    @log_lines = []
+    @unsent_lines = []
     @last_time = nil
     @feedback_interval = 2
     @last_output_was_from_command = false
@@ -366,23 +477,24 @@ class NetworkFeedback
   
   def start_job id
     @job_id = id
-    @log_lines.push "", "Build started at #{Time.now.strftime("%c")} (message id #{id})."
+    @unsent_lines.push "", "Build started at #{Time.now.strftime("%c")} (message id #{id})."
     check_flush!
   end
   
   def add_lines! *lines
-    @log_lines.push *lines
+    @unsent_lines.push *lines
     @last_output_was_from_command = false
     check_flush!
   end
   alias add_line! add_lines!
   
-  def check_flush!
-    @log_lines = @log_lines[-20..-1] if @log_lines.length > 20
+  # the server only receives the lines added since the previous flush
+  def check_flush! force = false
     now = Time.new
-    if @job_id
-      if @last_time.nil? || (now - @last_time >= @feedback_interval)
-        @communicator.send_console @job_id, @log_lines.join("\n")
+    if @job_id && !@unsent_lines.empty?
+      if force || @last_time.nil? || (now - @last_time >= @feedback_interval)
+        @communicator.send_console @job_id, @unsent_lines.collect { |line| "#{line}\n" }.join
+        @unsent_lines = []
         @last_time = now
       end
     end
@@ -398,19 +510,23 @@ class NetworkFeedback
   end
   
   def job_done id, options
+    check_flush! true
     @communicator.job_done id, options
   end
   
   def command_output output
     lines = output.split("\n")
-    if @last_output_was_from_command
-      if !@log_lines.empty? && lines.first =~ /\r([^\r]+)\Z/
-        @log_lines[-1] = $1
+    if @last_output_was_from_command && lines.first =~ /\r([^\r]+)\Z/
+      if @unsent_lines.empty?
+        # the line being overwritten has already been sent, so just append the new state
+        lines[0] = $1
+      else
+        @unsent_lines[-1] = $1
         lines.shift
       end
     end
     @last_output_was_from_command = !(lines.last =~ /\n\Z/)
-    @log_lines.push *lines
+    @unsent_lines.push *lines
     check_flush!
   end
   
@@ -451,27 +567,84 @@ class Multicast
 end
 
 feedback = ConsoleFeedback.new
-comm = ServerCommunication.new(feedback, config.server_host, config.builder_name, config.poll_interval)
+comm = ServerCommunication.new(feedback, config.server_host, config.builder_name, config.poll_interval, config.pool, config.tags)
+scripts = ScriptCache.new(comm, ENV['BUILDER_SCRIPT_CACHE'] || File.expand_path('~/.yoursway-builder/scripts'))
 
 class ExecutionError < StandardError
 end
 
-def process_stage stage, commands, executor
+def process_stage stage, commands, executor, &after_command
   1.times do
     retry if catch(:repeat_stage) do
       executor.start_stage! stage
-      commands.each { |command| executor.execute_command! stage,  command }
+      commands.each do |command|
+        executor.execute_command! stage,  command
+        after_command.call unless after_command.nil?
+      end
       executor.finish_stage! stage
     end
   end
 end
 
-def process_job feedback, builder_name, message_id, other_lines
+# sends the report records (a STORE line, or an ITEM line with its INSTORE and ACCESS lines)
+# to the server as soon as they appear, so that the downloads show up while building
+class ReportStreamer
+  
+  # seconds between checks for new records
+  INTERVAL = 10
+  
+  def initialize communicator, message_id
+    @communicator = communicator
+    @message_id = message_id
+    @sent_records = {}
+    @seq = 0
+    @failed = false
+    @last_check = Time.at(0)
+  end
+  
+  def check! executor, force = false
+    return if @failed
+    return unless force || Time.now - @last_check >= INTERVAL
+    @last_check = Time.now
+    new_records = records_of(executor.create_report).reject { |record| @sent_records[record] }
+    return if new_records.empty?
+    @seq += 1
+    if @communicator.send_report(@message_id, @seq, new_records.join("\n"))
+      new_records.each { |record| @sent_records[record] = true }
+    else
+      @failed = true
+    end
+  end
+  
+  # true if the server has got everything, so the final report need not be sent
+  def complete?
+    !@failed && @seq > 0
+  end
+  
+private
+
+  def records_of report
+    records = []
+    report.each do |row|
+      line = row.join("\t")
+      if ['INSTORE', 'ACCESS'].include?(row.first) && !records.empty?
+        records[-1] = "#{records[-1]}\n#{line}"
+      else
+        records << line
+      end
+    end
+    records
+  end
+  
+end
+
+def process_job feedback, builder_name, message_id, other_lines, scripts, streamer
   feedback.start_job message_id
   report = nil
   outcome = "SUCCESS"
   begin
     executor = Executor.new(builder_name, feedback)
+    other_lines = scripts.expand_includes(other_lines)
 
     commands = []
     lineno = 1
@@ -516,7 +689,7 @@ def process_job feedback, builder_name, message_id, other_lines
     
     executor.allow_fetching_items!
     feedback.with_target(FileFeedback.new(log_item.fetch_locally(nil))) do
-      process_stage :main,        commands, executor
+      process_stage(:main,        commands, executor) { streamer.check! executor }
     end
     
     executor.finish_build!
@@ -531,12 +704,19 @@ def process_job feedback, builder_name, message_id, other_lines
     failure_reason = "#{$!.class.name}: #{$!.message}\n#{($!.backtrace || []).join("\n")}"
   end
   begin
+    streamer.check! executor, true
+    report = executor.create_report.collect { |row| row.join("\t") }.join("\n")
+  rescue BuildAborted
     report = executor.create_report.collect { |row| row.join("\t") }.join("\n")
   rescue StandardError => e
     puts "ERROR CREATING REPORT: #{e}"
     report = ''
   end
-  feedback.job_done message_id, :report => report, :outcome => outcome, :failure_reason => failure_reason
+  if streamer.complete?
+    feedback.job_done message_id, :outcome => outcome, :failure_reason => failure_reason
+  else
+    feedback.job_done message_id, :report => report, :outcome => outcome, :failure_reason => failure_reason
+  end
 end
 
 while not interrupted
@@ -573,13 +753,17 @@ while not interrupted
         feedback.info "Poll interval set to #{config.poll_interval}"
       end
       
-      feedback.info "No outstanding jobs, gonna be lazing for #{config.poll_interval} seconds."
-      sleep config.poll_interval
+      # the server has already waited for us if it supports long polling
+      unless args[2] == 'LONGPOLL'
+        feedback.info "No outstanding jobs, gonna be lazing for #{config.poll_interval} seconds."
+        sleep config.poll_interval
+      end
     when 'SELFUPDATE'
       exit!(55)
     else
       message_id = args[1]
-      process_job Multicast.new(feedback, NetworkFeedback.new(comm)), config.builder_name, message_id, other_lines
+      process_job Multicast.new(feedback, NetworkFeedback.new(comm)), config.builder_name, message_id, other_lines, scripts,
+        ReportStreamer.new(comm, message_id)
     end
   end
 end
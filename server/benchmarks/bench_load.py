@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Load simulation of the whole server: main.application is driven in-process as a
+# WSGI application against the datastore, memcache, users and task queue stubs of
+# the App Engine SDK, with a fleet of builders taking and finishing continuous
+# builds and a crowd of people watching the project pages.
+#
+#   python benchmarks/bench_load.py [--builders 50] [--projects 200] [--viewers 20]
+#     [--rounds 20] [--seed 1] [--sdk /usr/local/google_appengine]
+#     [--save baseline.json] [--compare baseline.json] [--threshold 20]
+#
+# Every operation reports its throughput, latency percentiles and the datastore and
+# memcache calls it made. The same seed gives the same sequence of requests, so runs
+# can be compared: --save writes the results, and --compare prints the change against
+# saved results and exits with 1 when latency or calls per operation have grown by
+# more than --threshold percent.
+
+import glob
+import os
+import random
+import sys
+import time
+from cStringIO import StringIO
+from optparse import OptionParser
+from urllib import urlencode
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+APP_ID = 'yoursway-builder'
+
+def setup_sdk(sdk_path):
+  sys.path[0:0] = [SERVER_PATH, sdk_path] + glob.glob(os.path.join(sdk_path, 'lib', '*')) + [
+    os.path.join(sdk_path, 'lib', 'yaml', 'lib')]
+  os.environ.update(APPLICATION_ID = APP_ID, AUTH_DOMAIN = 'example.com', SERVER_SOFTWARE = 'Development/bench',
+    SERVER_NAME = 'localhost', SERVER_PORT = '8080', USER_EMAIL = '', USER_IS_ADMIN = '0')
+
+  from google.appengine.api import apiproxy_stub_map, datastore_file_stub, user_service_stub
+  from google.appengine.api.memcache import memcache_stub
+  try:
+    from google.appengine.api.taskqueue import taskqueue_stub
+  except ImportError:
+    from google.appengine.api.labs.taskqueue import taskqueue_stub
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore_file_stub.DatastoreFileStub(APP_ID, None, None))
+  apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub('taskqueue', taskqueue_stub.TaskQueueServiceStub(root_path = SERVER_PATH))
+  apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('bench-load', count_api_call)
+
+# the operation currently being measured and the calls it has made
+current_calls = None
+
+def count_api_call(service, call, request, response, *rem):
+  if current_calls is not None:
+    name = "%s.%s" % (service, call)
+    current_calls[name] = current_calls.get(name, 0) + 1
+
+class operation_stats(object):
+  def __init__(self, name):
+    self.name = name
+    self.latencies = []
+    self.calls = dict()
+
+  def add(self, seconds, calls):
+    self.latencies.append(seconds)
+    for name, count in calls.iteritems():
+      self.calls[name] = self.calls.get(name, 0) + count
+
+  def percentile(self, fraction):
+    latencies = sorted(self.latencies)
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000.0
+
+  # 'elapsed' is the wall-clock time of the whole run, which all operations share
+  def summary(self, elapsed):
+    count = len(self.latencies)
+    return dict(
+      count = count,
+      per_second = count / max(elapsed, 1e-9),
+      p50_ms = self.percentile(0.50),
+      p95_ms = self.percentile(0.95),
+      p99_ms = self.percentile(0.99),
+      calls = dict([(name, float(value) / count) for name, value in self.calls.iteritems()]),
+    )
+
+class load_simulation(object):
+  def __init__(self, application, options):
+    self.application = application
+    self.options = options
+    self.random = random.Random(options.seed)
+    self.stats = dict()
+    self.projects = []
+    self.builders = []
+    # the ETags the viewers have seen, for conditional requests
+    self.etags = dict()
+
+  # one WSGI request; returns (status code, body)
+  def request(self, operation, method, path, params = None, user = None, headers = {}):
+    global current_calls
+    body = ''
+    query = ''
+    if params and method == 'GET':
+      query = urlencode(params)
+    elif params:
+      body = urlencode(params)
+    environ = dict(os.environ)
+    environ.update({
+      'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+      'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'CONTENT_LENGTH': str(len(body)),
+      'HTTP_HOST': 'localhost:8080', 'wsgi.input': StringIO(body), 'wsgi.errors': sys.stderr,
+      'wsgi.url_scheme': 'http', 'wsgi.version': (1, 0), 'wsgi.multithread': False,
+      'wsgi.multiprocess': False, 'wsgi.run_once': False,
+      'USER_EMAIL': user or '', 'USER_IS_ADMIN': '0',
+    })
+    for name, value in headers.iteritems():
+      environ['HTTP_' + name.upper().replace('-', '_')] = value
+    os.environ['USER_EMAIL'] = user or ''
+    status = []
+    def start_response(status_line, response_headers, exc_info = None):
+      status.append(int(status_line.split(' ', 1)[0]))
+    current_calls = dict()
+    started_at = time.time()
+    try:
+      output = ''.join(self.application(environ, start_response))
+    finally:
+      seconds = time.time() - started_at
+      calls, current_calls = current_calls, None
+    self.stats.setdefault(operation, operation_stats(operation)).add(seconds, calls)
+    return status[0], output
+
+  def populate(self):
+    from builder.models import InstallationConfig, Project, Profile, NORMAL_LEVEL, invalidate_config
+    config = InstallationConfig()
+    config.put()
+    invalidate_config()
+    for i in xrange(self.options.viewers):
+      Profile(email = viewer_email(i), level = NORMAL_LEVEL).put()
+    for i in xrange(self.options.projects):
+      project = Project(name = "Project %d" % i, permalink = "project%d" % i, is_public = (i % 2 == 0),
+        continuous_pool = 'default', continuous_token = "token%d" % i,
+        script = "REPOS\tmain\t-\tMain\n\tGIT\torigin\t-\tgit://example.com/project%d.git\nVERSION\tmain\tmain\theads/master" % i)
+      project.derive_info_from_script(config.common_script)
+      project.put()
+      self.projects.append(project.permalink)
+    for i in xrange(self.options.builders):
+      self.builders.append(simulated_builder("builder%d" % i))
+
+  def trigger(self, permalink):
+    self.request('trigger', 'POST', '/projects/%s/start_continuous_build' % permalink,
+      dict(token = "token%s" % permalink[len('project'):]))
+
+  def run_builder(self, builder):
+    if builder.message_key is None:
+      status, body = self.request('obtain-work', 'POST', '/builders/%s/obtain-work' % builder.name,
+        dict(pool = 'default', includes = '1'))
+      if body.startswith('ENVELOPE'):
+        builder.message_key = body.split("\n", 1)[0].split("\t")[2]
+        builder.steps_left = self.random.randint(1, 4)
+        builder.report_seq = 0
+      return
+    if builder.steps_left > 0:
+      builder.steps_left -= 1
+      self.request('report-progress', 'POST', '/messages/%s/report_progress' % builder.message_key,
+        dict(append = ("step %d of the build\n" % builder.steps_left) * 20))
+      builder.report_seq += 1
+      self.request('report', 'POST', '/builders/%s/messages/%s/report' % (builder.name, builder.message_key),
+        dict(seq = str(builder.report_seq), records = "ITEM\tfile\tout%d.zip\tfeatured\tOutput" % builder.report_seq))
+      return
+    self.request('done', 'POST', '/builders/%s/messages/%s/done' % (builder.name, builder.message_key),
+      dict(outcome = self.random.choice(['SUCCESS', 'SUCCESS', 'SUCCESS', 'ERR']), failure_reason = 'failed'))
+    builder.message_key = None
+
+  def run_viewer(self, i):
+    permalink = self.random.choice(self.projects)
+    user = viewer_email(i)
+    self.request('project-page', 'GET', '/projects/%s' % permalink, user = user)
+    self.request('live-updates', 'POST', '/projects/%s/updates' % permalink, dict(watch = "REVISION\t0"), user = user)
+    self.request('api-project', 'GET', '/api/projects/%s' % permalink, user = user)
+    etag = self.etags.get(permalink)
+    if etag is not None:
+      self.request('api-project-conditional', 'GET', '/api/projects/%s' % permalink, user = user,
+        headers = {'If-None-Match': etag})
+    self.request('projects-page', 'GET', '/projects', user = user)
+
+  def run(self):
+    self.populate()
+    started_at = time.time()
+    for round in xrange(self.options.rounds):
+      for permalink in self.random.sample(self.projects, min(len(self.projects), self.options.triggers)):
+        self.trigger(permalink)
+      for builder in self.builders:
+        self.run_builder(builder)
+      for i in xrange(self.options.viewers):
+        self.run_viewer(i)
+      self.remember_etags()
+    return time.time() - started_at
+
+  def remember_etags(self):
+    from builder.models import project_stub, project_revision, id_or_name_of
+    from google.appengine.ext import db
+    for permalink in self.projects:
+      key = project_stub(permalink)['key']
+      revision = project_revision(key)
+      if revision is not None:
+        self.etags[permalink] = '"%s-%d"' % (id_or_name_of(db.Key(key)), revision[0])
+
+def viewer_email(i):
+  return "viewer%d@example.com" % i
+
+class simulated_builder(object):
+  def __init__(self, name):
+    self.name = name
+    self.message_key = None
+    self.steps_left = 0
+    self.report_seq = 0
+
+def print_results(results, elapsed, baseline = None, threshold = None):
+  regressions = []
+  total = sum([summary['count'] for summary in results.itervalues()])
+  print "%d requests in %.1f s (%.1f requests/s)" % (total, elapsed, total / elapsed)
+  print "%-24s %7s %9s %9s %9s %9s  %s" % ('operation', 'count', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'calls per operation')
+  for name in sorted(results.keys()):
+    summary = results[name]
+    calls = ', '.join(["%s %.1f" % (call, count) for call, count in sorted(summary['calls'].items())])
+    print "%-24s %7d %9.1f %9.1f %9.1f %9.1f  %s" % (name, summary['count'], summary['per_second'],
+      summary['p50_ms'], summary['p95_ms'], summary['p99_ms'], calls)
+    if baseline is None or name not in baseline:
+      continue
+    before = baseline[name]
+    changes = [(metric, before[metric], summary[metric]) for metric in ('p50_ms', 'p95_ms', 'p99_ms')]
+    changes += [(call, before['calls'].get(call, 0), count) for call, count in summary['calls'].items()]
+    for metric, old, new in changes:
+      change = percent_change(old, new)
+      if change is None:
+        continue
+      marker = ''
+      if change > threshold:
+        marker = '  REGRESSION'
+        regressions.append((name, metric))
+      if abs(change) >= 1:
+        print "%24s %-26s %9.1f -> %9.1f (%+.0f%%)%s" % ('', metric, old, new, change, marker)
+  return regressions
+
+def percent_change(old, new):
+  if old == 0:
+    if new == 0:
+      return None
+    return 100.0
+  return (new - old) * 100.0 / old
+
+def main():
+  parser = OptionParser()
+  parser.add_option('--builders', type = 'int', default = 50)
+  parser.add_option('--projects', type = 'int', default = 200)
+  parser.add_option('--viewers', type = 'int', default = 20)
+  parser.add_option('--triggers', type = 'int', default = 10, help = 'continuous builds triggered per round')
+  parser.add_option('--rounds', type = 'int', default = 20)
+  parser.add_option('--seed', type = 'int', default = 1)
+  parser.add_option('--sdk', default = os.environ.get('APPENGINE_SDK', '/usr/local/google_appengine'))
+  parser.add_option('--save', metavar = 'FILE')
+  parser.add_option('--compare', metavar = 'FILE')
+  parser.add_option('--threshold', type = 'float', default = 20.0, help = 'percent of growth reported as a regression')
+  options, args = parser.parse_args()
+
+  setup_sdk(options.sdk)
+  from django.utils import simplejson
+  import main as server
+
+  simulation = load_simulation(server.application, options)
+  elapsed = simulation.run()
+  results = dict([(name, stats.summary(elapsed)) for name, stats in simulation.stats.iteritems()])
+
+  baseline = None
+  if options.compare:
+    baseline = simplejson.load(open(options.compare))['operations']
+  regressions = print_results(results, elapsed, baseline, options.threshold)
+  if options.save:
+    simplejson.dump(dict(options = options.__dict__, elapsed = elapsed, operations = results),
+      open(options.save, 'w'), indent = 2, sort_keys = True)
+  if regressions:
+    print "%d regression(s) against %s" % (len(regressions), options.compare)
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmark of tabular.untabularize against the implementation it replaced.
+#
+#   python benchmarks/bench_tabular.py [repetitions]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tabular import untabularize
+from builder.data.perproject import script_info
+from builder.data.artifacts import report_info
+
+# the parser as it was before handler lookups were cached
+def untabularize_reference(receiver, script, *root_context_args):
+  prev_command = None
+  context_args = ()
+  for line in script.split("\n"):
+    stripped = line.strip()
+    if len(stripped) == 0 or stripped.startswith('#'):
+      continue
+    fields = line.split("\t")
+    if len(fields[0]) == 0:
+      command, args = fields[1].lower(), fields[2:]
+      handler_name = "on_%s_%s" % (prev_command, command)
+      
+      if hasattr(receiver, handler_name):
+        getattr(receiver, handler_name)(*(context_args + tuple(args)))
+      
+    else:
+      if prev_command:
+        handler_name = "after_%s" % prev_command
+        if hasattr(receiver, handler_name):
+          getattr(receiver, handler_name)(*context_args)
+      
+      command, args = fields[0].lower(), fields[1:]
+      handler_name = "on_%s" % command
+      prev_command = command
+      
+      if not hasattr(receiver, handler_name):
+        continue
+      context_args = (getattr(receiver, handler_name)(*(root_context_args + tuple(args))) or ())
+      if context_args and not (type(context_args) is tuple):
+        if type(context_args) is list:
+          context_args = tuple(context_args)
+        else:
+          context_args = (context_args,)
+    
+  if prev_command:
+    handler_name = "after_%s" % prev_command
+    if hasattr(receiver, handler_name):
+      getattr(receiver, handler_name)(*context_args)
+      
+  return receiver
+
+def sample_script(num_repos = 300):
+  lines = []
+  for i in xrange(num_repos):
+    lines.append("REPOS\trepos%d\t-\tRepository %d" % (i, i))
+    for location in ('origin', 'mirror', 'backup'):
+      lines.append("\tGIT\t%s\t-\tgit://example.com/%s/repos%d.git" % (location, location, i))
+    lines.append("VERSION\tv%d\trepos%d\theads/master" % (i, i))
+    lines.append("# comment %d" % i)
+    lines.append("")
+  return "\n".join(lines)
+
+def sample_report(num_items = 2000):
+  lines = ["STORE\tpublic\tpublic\tPublic downloads", "STORE\tlocal\t-\t-"]
+  for i in xrange(num_items):
+    lines.append("ITEM\tfile\titem%d.zip\tfeatured\tItem %d" % (i, i))
+    lines.append("INSTORE\tpublic")
+    lines.append("ACCESS\turl\t-\thttp://example.com/item%d.zip" % i)
+    lines.append("INSTORE\tlocal")
+    lines.append("ACCESS\tpath\t-\t/builds/item%d.zip" % i)
+  return "\n".join(lines)
+
+def measure(name, parse, make_receiver, text, repetitions):
+  seconds = min(timeit.repeat(lambda: parse(make_receiver(), text), number = repetitions, repeat = 3))
+  print "  %-10s %8.2f ms per parse" % (name, seconds * 1000.0 / repetitions)
+  return seconds
+
+def main():
+  repetitions = int((sys.argv[1:] or ['20'])[0])
+  for title, make_receiver, text in [
+      ("script (%d lines)", script_info, sample_script()),
+      ("report (%d lines)", report_info, sample_report())]:
+    print title % (text.count("\n") + 1)
+    text = text.decode('utf-8')  # the datastore hands out unicode
+    before = measure("before", untabularize_reference, make_receiver, text, repetitions)
+    after = measure("after", untabularize, make_receiver, text, repetitions)
+    print "  speedup    %8.2fx" % (before / after)
+
+if __name__ == '__main__':
+  main()
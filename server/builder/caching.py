@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import time
+from google.appengine.api import memcache
+
+# values are cached in memcache and additionally in the memory of this
+# instance for a short time; other instances may see a stale value for up to
+# LOCAL_TTL seconds after an invalidation
+LOCAL_TTL = 30
+MEMCACHE_TTL = 60*60
+
+_local_cache = dict()
+
+def get_cached(key):
+  now = time.time()
+  entry = _local_cache.get(key)
+  if entry is not None and entry[0] > now:
+    return pickle.loads(entry[1])
+  data = memcache.get(key)
+  if data is None:
+    return None
+  _local_cache[key] = (now + LOCAL_TTL, data)
+  return pickle.loads(data)
+
+def set_cached(key, value):
+  # stored pickled so that every request gets its own copy of the value
+  data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+  memcache.set(key, data, time = MEMCACHE_TTL)
+  _local_cache[key] = (time.time() + LOCAL_TTL, data)
+
+def invalidate_cached(*keys):
+  memcache.delete_multi(list(keys))
+  for key in keys:
+    _local_cache.pop(key, None)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+# the console of a message is kept in memcache as numbered chunks of appended
+# output; 'console-<key>' holds the number of the last chunk, and
+# 'progress-<key>' becomes "FIN" once the builder is done with the message.
+# Every PAGE_CHUNKS chunks (and when the message is finished) the chunks are
+# compressed into a ConsolePage, so memcache is only a hot cache of the log.
+CONSOLE_TTL = 60*60
+MAX_CHUNKS_PER_READ = 100
+PAGE_CHUNKS = 50
+
+class ConsolePage(db.Model):
+  # the key name is "<message key>-p<number>"; pages are kept out of the project's
+  # entity group, which already takes the state changes of all its builds
+  message = db.ReferenceProperty()
+  number = db.IntegerProperty()
+  first_chunk = db.IntegerProperty()
+  last_chunk = db.IntegerProperty()
+  # the last chunk of this page that replaced everything before it, if any
+  reset_chunk = db.IntegerProperty()
+  # offsets in the uncompressed text where each chunk ends
+  chunk_ends = db.ListProperty(int)
+  data = db.BlobProperty()
+  created_at = db.DateTimeProperty(auto_now_add = True)
+
+  @staticmethod
+  def key_name_for(message_key, number):
+    return "%s-p%d" % (message_key, number)
+
+  def text(self):
+    if not hasattr(self, '_text'):
+      self._text = zlib.decompress(self.data).decode('utf-8')
+    return self._text
+
+  # returns (reset, text) for the chunks starting with 'number'
+  def text_from(self, number):
+    if self.reset_chunk is not None and number <= self.reset_chunk:
+      return True, self.text()
+    if number <= self.first_chunk:
+      return False, self.text()
+    return False, self.text()[self.chunk_ends[number - self.first_chunk - 1]:]
+
+def console_count_key(message_key):
+  return "console-%s" % message_key
+
+def console_chunk_key(message_key, number):
+  return "console-%s-%d" % (message_key, number)
+
+def console_state_key(message_key):
+  return "progress-%s" % message_key
+
+def console_pages_key(message_key):
+  return "console-%s-pages" % message_key
+
+def console_page_key(message_key, number):
+  return "console-%s-page-%d" % (message_key, number)
+
+def console_flush_lock_key(message_key):
+  return "console-%s-flushing" % message_key
+
+# a replacing chunk discards everything before it (used for full console snapshots)
+def append_console(message_key, text, replace = False):
+  number = memcache.incr(console_count_key(message_key), initial_value = 0)
+  if number is None:
+    return None
+  memcache.set(console_chunk_key(message_key, number), (replace, text), time = CONSOLE_TTL)
+  if number % PAGE_CHUNKS == 0:
+    flush_console(message_key)
+  return number
+
+# returns (number of the last chunk stored in pages, number of pages)
+def flushed_console_state(message_key):
+  state = memcache.get(console_pages_key(message_key))
+  if state is None:
+    page = ConsolePage.all().filter('message =', db.Key(str(message_key))).order('-number').get()
+    if page is None:
+      state = (0, 0)
+    else:
+      state = (page.last_chunk, page.number)
+    memcache.set(console_pages_key(message_key), state, time = CONSOLE_TTL)
+  return state
+
+# writes the chunks not stored yet into a new page; returns the number of pages
+def flush_console(message_key):
+  flushed, pages = flushed_console_state(message_key)
+  count = memcache.get(console_count_key(message_key))
+  if count is None or count <= flushed:
+    return pages
+  if not memcache.add(console_flush_lock_key(message_key), 1, time = 10):
+    return pages
+  try:
+    numbers = range(flushed + 1, count + 1)
+    chunks = memcache.get_multi([console_chunk_key(message_key, n) for n in numbers])
+    parts = []
+    chunk_ends = []
+    size = 0
+    reset_chunk = None
+    for number in numbers:
+      replace, text = chunks.get(console_chunk_key(message_key, number), (False, u''))
+      if replace:
+        parts = []
+        chunk_ends = [0] * len(chunk_ends)
+        size = 0
+        reset_chunk = number
+      parts.append(text)
+      size += len(text)
+      chunk_ends.append(size)
+    pages += 1
+    page = ConsolePage(key_name = ConsolePage.key_name_for(message_key, pages), message = db.Key(str(message_key)),
+      number = pages, first_chunk = flushed + 1, last_chunk = count, reset_chunk = reset_chunk,
+      chunk_ends = chunk_ends, data = db.Blob(zlib.compress(u''.join(parts).encode('utf-8'))))
+    page.put()
+    memcache.set(console_pages_key(message_key), (count, pages), time = CONSOLE_TTL)
+    return pages
+  finally:
+    memcache.delete(console_flush_lock_key(message_key))
+
+# stores the remaining output and tells the viewers that the console is complete;
+# returns the number of pages
+def finish_console(message_key):
+  pages = flush_console(message_key)
+  memcache.set(console_state_key(message_key), "FIN", time = CONSOLE_TTL)
+  return pages
+
+# finish_console for many messages at once; returns a dict of page counts by message key
+def finish_consoles(message_keys):
+  message_keys = [str(key) for key in message_keys]
+  values = memcache.get_multi([console_count_key(key) for key in message_keys] +
+    [console_pages_key(key) for key in message_keys])
+  result = {}
+  for key in message_keys:
+    count = values.get(console_count_key(key))
+    state = values.get(console_pages_key(key))
+    if state is None or (count is not None and count > state[0]):
+      result[key] = flush_console(key)
+    else:
+      result[key] = state[1]
+  memcache.set_multi(dict([(console_state_key(key), "FIN") for key in message_keys]), time = CONSOLE_TTL)
+  return result
+
+# returns a dict of (number of the last chunk or None, finished) by message key, read from memcache only
+def console_positions(message_keys):
+  message_keys = [str(key) for key in message_keys]
+  values = memcache.get_multi([console_count_key(key) for key in message_keys] +
+    [console_state_key(key) for key in message_keys])
+  return dict([(key, (values.get(console_count_key(key)), values.get(console_state_key(key)) == "FIN"))
+    for key in message_keys])
+
+def read_console_page(message_key, number):
+  key = console_page_key(message_key, number)
+  page = memcache.get(key)
+  if page is None:
+    page = ConsolePage.get_by_key_name(ConsolePage.key_name_for(message_key, number))
+    if page is not None:
+      memcache.set(key, page, time = CONSOLE_TTL)
+  return page
+
+def find_console_page(message_key, chunk_number):
+  flushed, pages = flushed_console_state(message_key)
+  if chunk_number > flushed:
+    return None
+  return ConsolePage.all().filter('message =', db.Key(str(message_key))).filter('last_chunk >=', chunk_number).order('last_chunk').get()
+
+class console_delta(object):
+  def __init__(self, offset, text = '', reset = False, finished = False, waiting = False):
+    self.offset = offset
+    self.text = text
+    self.reset = reset
+    self.finished = finished
+    self.waiting = waiting
+
+def console_delta_from_page(page, number):
+  reset, text = page.text_from(number)
+  return console_delta(page.last_chunk, text, reset = reset)
+
+# returns the output appended after the chunk number 'offset'
+def read_console(message_key, offset = 0):
+  values = memcache.get_multi([console_count_key(message_key), console_state_key(message_key)])
+  count = values.get(console_count_key(message_key))
+  finished = (values.get(console_state_key(message_key)) == "FIN")
+  if count is None or offset > count:
+    # memcache has lost the console, fall back to the stored pages
+    page = find_console_page(message_key, offset + 1)
+    if page is None:
+      return console_delta(offset, finished = finished, waiting = not finished)
+    return console_delta_from_page(page, offset + 1)
+  last = min(count, offset + MAX_CHUNKS_PER_READ)
+  numbers = range(offset + 1, last + 1)
+  chunks = memcache.get_multi([console_chunk_key(message_key, n) for n in numbers])
+  parts = []
+  reset = False
+  for number in numbers:
+    chunk = chunks.get(console_chunk_key(message_key, number))
+    if chunk is None:
+      if parts or reset:
+        break
+      if number == offset + 1 and number == numbers[0]:
+        page = find_console_page(message_key, number)
+        if page is not None:
+          return console_delta_from_page(page, number)
+      if number == count:
+        # not written yet, the reader will retry from here
+        break
+      # evicted before it was stored, skip it
+      offset = number
+      continue
+    replace, text = chunk
+    if replace:
+      parts = []
+      reset = True
+    parts.append(text)
+    offset = number
+  return console_delta(offset, ''.join(parts), reset = reset, finished = finished and offset == count)
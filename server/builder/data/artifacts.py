@@ -0,0 +1,129 @@
+
+from builder.utils import append
+
+def split_tags(s):
+  if s == '-':
+    return []
+  else:
+    return s.split(',')
+
+def join_tags(tags):
+  return ','.join(tags) or '-'
+
+# featured files available from public stores, as shown on the project and build pages;
+# public stores without items are kept too, since a streamed report may fill them later
+class artifact_index_info(object):
+  def __init__(self):
+    self.stores = []
+    self.stores_by_name = dict()
+    self._current_store = None
+
+  def add_store(self, store):
+    self.stores_by_name[store.name] = store
+    return append(self.stores, store)
+
+  def store_named(self, name):
+    return self.stores_by_name.get(name)
+
+  def tabularize(self, out):
+    for store in self.stores:
+      out.row('STORE', store.name, join_tags(store.tags), store.description)
+      for item in store.items:
+        out.row('ITEM', item.kind, item.name, join_tags(item.tags), item.description)
+        if item.url_location:
+          out.subrow('URL', item.url_location.kind, join_tags(item.url_location.tags), item.url_location.path)
+        for location in item.other_locations:
+          out.subrow('LOCATION', location.kind, join_tags(location.tags), location.path)
+
+  def on_store(self, name, tags, description):
+    self._current_store = self.add_store(store_info(name, split_tags(tags), description))
+
+  def on_item(self, kind, name, tags, description):
+    return self._current_store.add(item_info(kind, name, split_tags(tags), description))
+
+  def on_item_url(self, item, kind, tags, path):
+    item.url_location = location_info(kind, split_tags(tags), path)
+
+  def on_item_location(self, item, kind, tags, path):
+    item.other_locations.append(location_info(kind, split_tags(tags), path))
+
+# reads the STORE/ITEM/INSTORE/ACCESS report of a builder into an artifact index;
+# a report that arrives in parts is read part by part into the index of the earlier ones
+class report_info(object):
+  def __init__(self, index = None):
+    if index is None:
+      index = artifact_index_info()
+    self.index = index
+    self.last_item = None
+    self.last_item_in_store = None
+
+  def on_store(self, name, tags = '-', description = '-', *rem):
+    if description == '-' or description == '':
+      description = name
+    tags = split_tags(tags)
+    # items only ever go to public stores
+    if 'public' in tags and self.index.store_named(name) is None:
+      self.index.add_store(store_info(name, tags, description))
+
+  def on_item(self, kind, name, tags = '-', description = '-', *rem):
+    tags = split_tags(tags)
+    self.last_item_in_store = self.last_item = None
+    if kind != 'file' or not 'featured' in tags:
+      # skip this item
+      return
+    if description == '-':
+      description = name
+    self.last_item = item_info(kind, name, tags, description)
+
+  def on_instore(self, name, *rem):
+    self.last_item_in_store = None
+    store = self.index.store_named(name)
+    if self.last_item is None or store is None:
+      return
+    # streamed reports resend an item when it lands in another store; the last mention wins
+    self.last_item_in_store = store.replace(item_info(
+      self.last_item.kind, self.last_item.name, self.last_item.tags, self.last_item.description))
+
+  def on_access(self, kind, tags = '-', path = '', *rem):
+    if self.last_item_in_store is None:
+      return
+    location = location_info(kind, split_tags(tags), path)
+    if kind == 'url' and self.last_item_in_store.url_location is None:
+      self.last_item_in_store.url_location = location
+    else:
+      self.last_item_in_store.other_locations.append(location)
+
+class store_info(object):
+  def __init__(self, name, tags, description):
+    self.name = name
+    self.tags = tags
+    self.description = description
+    self.items = []
+    self.item_positions = dict()
+
+  def add(self, item):
+    self.item_positions[item.name] = len(self.items)
+    return append(self.items, item)
+
+  # the item takes the place of an earlier one with the same name
+  def replace(self, item):
+    position = self.item_positions.get(item.name)
+    if position is None:
+      return self.add(item)
+    self.items[position] = item
+    return item
+
+class item_info(object):
+  def __init__(self, kind, name, tags, description):
+    self.kind = kind
+    self.name = name
+    self.tags = tags
+    self.description = description
+    self.url_location = None
+    self.other_locations = []
+
+class location_info(object):
+  def __init__(self, kind, tags, path):
+    self.kind = kind
+    self.tags = tags
+    self.path = path
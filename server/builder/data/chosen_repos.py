@@ -27,9 +27,9 @@ class repo_configuration_info(object):
   def add_choice(self, choice):
     self.choices_by_repo[choice.repos_name] = append(self.choices, choice)
     
-  def tabularize(self, array):
+  def tabularize(self, out):
     for choice in self.choices:
-      array.append(['CHOOSE', choice.repos_name, choice.reason, choice.location_name])
+      out.row('CHOOSE', choice.repos_name, choice.reason, choice.location_name)
       
   def on_choose(self, repos_name, reason, location_name):
     self.add_choice(repo_choice_info(repos_name, reason, location_name))
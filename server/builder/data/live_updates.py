@@ -0,0 +1,41 @@
+
+from builder.utils import append
+
+def parse_int(s, default = None):
+  try:
+    return int(s)
+  except ValueError:
+    return default
+
+# what a page already shows, sent with every request for live updates:
+#   REVISION <project revision>
+#   WATCH <build key> <state name> <message key or -> <console offset> <fragment or ->
+class watch_list_info(object):
+  def __init__(self):
+    self.revision = None
+    self.watches = []
+
+  def tabularize(self, out):
+    out.row('REVISION', self.revision)
+    for watch in self.watches:
+      out.row('WATCH', watch.build_key, watch.state, watch.message_key, watch.offset, watch.fragment)
+
+  def on_revision(self, revision = '', *rem):
+    self.revision = parse_int(revision)
+
+  def on_watch(self, build_key, state = '-', message_key = '-', offset = '0', fragment = '-', *rem):
+    append(self.watches, watch_info(build_key, state, none_if_dash(message_key),
+      max(0, parse_int(offset, 0)), none_if_dash(fragment)))
+
+def none_if_dash(s):
+  if s == '-' or s == '':
+    return None
+  return s
+
+class watch_info(object):
+  def __init__(self, build_key, state, message_key, offset, fragment):
+    self.build_key = build_key
+    self.state = state
+    self.message_key = message_key
+    self.offset = offset
+    self.fragment = fragment
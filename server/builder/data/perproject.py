@@ -6,11 +6,11 @@ class script_info(object):
     self.alternable_repositories = []
     self.all_repositories = []
     
-  def tabularize(self, array):
+  def tabularize(self, out):
     for repos in self.alternable_repositories:
-      array.append(['AREPOSINFO', repos.name, repos.permalink, repos.descr])
+      out.row('AREPOSINFO', repos.name, repos.permalink, repos.descr)
       for location in repos.locations:
-        array.append(['','LOCATION',location.name])
+        out.subrow('LOCATION', location.name)
 
   def on_areposinfo(self, name, permalink, descr):
     return append(self.alternable_repositories, repos_info(name, descr, permalink = permalink))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import time
+from google.appengine.api import memcache
+
+# how long an idle marker stays valid without being confirmed by a full poll;
+# this also bounds how stale Builder.last_check_at gets in the datastore
+IDLE_MARKER_TTL = 10*60
+LAST_CHECK_TTL = 24*60*60
+
+# long polls must finish well within the request deadline
+LONG_POLL_MAX_WAIT = 20
+LONG_POLL_CHECK_INTERVAL = 0.5
+
+def work_generation_key(builder_name):
+  return "workgen-%s" % builder_name
+
+def pool_generation_key(pool):
+  return "poolgen-%s" % pool
+
+def idle_marker_key(builder_name):
+  return "idle-%s" % builder_name
+
+def last_check_key(builder_name):
+  return "lastcheck-%s" % builder_name
+
+# returns the numbers of queue changes seen for the builder and for its pool
+# as a (builder, pool) tuple; None if memcache is unavailable
+def current_work_generation(builder_name, pool):
+  keys = [work_generation_key(builder_name), pool_generation_key(pool)]
+  values = memcache.get_multi(keys)
+  missing = [key for key in keys if key not in values]
+  if missing:
+    memcache.add_multi(dict([(key, 0) for key in missing]))
+    values = memcache.get_multi(keys)
+  if len(values) < len(keys):
+    return None
+  return tuple([values[key] for key in keys])
+
+# invalidates the idle markers of the given builders, forcing their next poll down the full path
+def note_work_changed(*builder_names):
+  bump_generations([work_generation_key(name) for name in builder_names],
+    [idle_marker_key(name) for name in builder_names])
+
+# wakes up every builder of the pools
+def note_pool_work_changed(*pools):
+  bump_generations([pool_generation_key(pool) for pool in pools])
+
+def bump_generations(keys, markers = []):
+  if not keys:
+    return
+  generations = memcache.offset_multi(dict([(key, 1) for key in keys]), initial_value = 0)
+  failed = [key for key in keys if generations.get(key) is None]
+  if failed:
+    # without the counters no idle marker can be trusted
+    memcache.delete_multi(markers or failed)
+
+# 'capabilities' is what the builder told about itself (pool and tags) when the marker was made;
+# a builder that changes them has to be answered from the datastore again
+def remember_idle(builder_name, generation, response, capabilities):
+  if generation is not None:
+    memcache.set(idle_marker_key(builder_name), (generation, response, capabilities), time = IDLE_MARKER_TTL)
+
+# returns (generation, response) if the builder is known to have nothing to do, otherwise None
+def cached_idle_marker(builder_name, pool, capabilities):
+  keys = [idle_marker_key(builder_name), work_generation_key(builder_name), pool_generation_key(pool)]
+  values = memcache.get_multi(keys)
+  marker = values.get(keys[0])
+  if marker is None or len(marker) != 3 or marker[2] != capabilities:
+    return None
+  if marker[0] != (values.get(keys[1]), values.get(keys[2])):
+    return None
+  return marker[0:2]
+
+# sleeps until the work generation of the builder or its pool changes or the deadline passes;
+# returns True in the first case
+def wait_for_work(builder_name, pool, generation, deadline):
+  if generation is None:
+    return False
+  keys = [work_generation_key(builder_name), pool_generation_key(pool)]
+  while time.time() < deadline:
+    time.sleep(min(LONG_POLL_CHECK_INTERVAL, max(0, deadline - time.time())))
+    values = memcache.get_multi(keys)
+    if (values.get(keys[0]), values.get(keys[1])) != generation:
+      return True
+  return False
+
+def record_builder_check(builder_name, now):
+  memcache.set(last_check_key(builder_name), now, time = LAST_CHECK_TTL)
+
+# returns a dict mapping builder names to the last poll times known to memcache
+def recent_builder_checks(builders):
+  values = memcache.get_multi([last_check_key(builder.name) for builder in builders])
+  result = dict()
+  for builder in builders:
+    check = values.get(last_check_key(builder.name))
+    if check is not None:
+      result[builder.name] = check
+  return result
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+import logging
+import urllib
+
+from email.utils import formatdate, parsedate
+from django.utils import simplejson
+from google.appengine.ext import db
+
+from builder.models import *
+from builder.handlers.base import prolog, BaseHandler, FinishRequest
+
+# machine-readable status for wall monitors and scripts. Everything under a project
+# is served with an ETag and Last-Modified derived from the project revision (see
+# project_revision), and a poll carrying the current ETag is answered with 304
+# before the prolog runs any queries. Queue positions and builders change along with
+# other projects and are served separately, without validators.
+
+def format_time(value):
+  if value is None:
+    return None
+  return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def http_date(value):
+  return formatdate(calendar.timegm(value.utctimetuple()), usegmt = True)
+
+def etag_matches(header, etag):
+  return header.strip() == '*' or etag in [tag.strip() for tag in header.split(',')]
+
+# answers with 304 Not Modified, before the prolog, when the client already has the
+# current revision of the project named by the first path component
+def conditional_on_project(method):
+  def decoration(self, project_component, *args):
+    if self.project_not_modified(urllib.unquote(project_component)):
+      return
+    return method(self, project_component, *args)
+  decoration.__name__ = method.__name__
+  decoration.__dict__ = method.__dict__
+  decoration.__doc__  = method.__doc__
+  return decoration
+
+class ApiHandler(BaseHandler):
+
+  def project_not_modified(self, permalink):
+    stub = project_stub(permalink)
+    if stub is None:
+      return False
+    if not stub['is_public']:
+      # profiles are cached, so this usually costs no queries either
+      self.read_user()
+      if self.profile.level < VIEWER_LEVEL:
+        return False
+    revision = project_revision(stub['key'])
+    if revision is None:
+      return False
+    number, updated_at = revision
+    etag = '"%s-%d"' % (id_or_name_of(db.Key(stub['key'])), number)
+    self.response.headers['ETag'] = etag
+    self.response.headers['Last-Modified'] = http_date(updated_at)
+    self.response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+
+    if_none_match = self.request.headers.get('If-None-Match')
+    if if_none_match is not None:
+      not_modified = etag_matches(if_none_match, etag)
+    else:
+      since = parsedate(self.request.headers.get('If-Modified-Since', ''))
+      not_modified = since is not None and calendar.timegm(since) >= calendar.timegm(updated_at.utctimetuple())
+    if not_modified:
+      self.response.set_status(304)
+    return not_modified
+
+  def render_json_and_finish(self, value):
+    self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+    self.response.out.write(simplejson.dumps(value))
+    raise FinishRequest
+
+  def project_url(self, project):
+    return 'http://%s/projects/%s' % (self.request.host, urllib.quote(project.urlname().encode('utf-8')))
+
+  def project_json(self, project):
+    return dict(
+      name = project.name,
+      urlname = project.urlname(),
+      url = self.project_url(project),
+      api_url = 'http://%s/api/projects/%s' % (self.request.host, urllib.quote(project.urlname().encode('utf-8'))),
+      is_public = project.is_public,
+    )
+
+  # the builds are always of self.project
+  def build_json(self, build):
+    result = dict(
+      version = build.version,
+      url = '%s/builds/%s' % (self.project_url(self.project), urllib.quote(build.urlname().encode('utf-8'))),
+      state = build.state_name(),
+      priority = priority_names.get(build.priority),
+      target = build.target_name(),
+      created_at = format_time(build.created_at),
+      dispatched_at = format_time(build.dispatched_at),
+      finished_at = format_time(build.finished_at),
+      expected_finish_at = format_time(build.expected_finish_at),
+      created_by = build.created_by and build.created_by.nickname(),
+      merged_triggers = build.merged_triggers,
+    )
+    if build.state == BUILD_FAILED:
+      result.update(failure_reason = build.failure_reason_summary())
+    return result
+
+  def dashboard_builds(self):
+    dashboard = load_dashboard(self.project, self.config)
+    entities = dict([(e.key(), e) for e in db.get(dashboard.all_keys()) if e is not None])
+    builds = dict([(name, [entities[k] for k in keys if entities.has_key(k)]) for name, keys in (
+      ('latest_builds', dashboard.latest_builds),
+      ('unsuccessful_builds', dashboard.recent_builds),
+      ('successful_builds', dashboard.successful_builds))])
+    prefetch_references(sum(builds.values(), []), Build.builder)
+    return dashboard, entities, builds
+
+class ApiProjectsHandler(ApiHandler):
+  @prolog(fetch = ['projects'])
+  def get(self):
+    self.render_json_and_finish(dict(
+      projects = [self.project_json(project) for project in self.projects],
+      next_page = self.data['next_page_url'] and 'http://%s%s' % (self.request.host, self.data['next_page_url']),
+    ))
+
+class ApiProjectHandler(ApiHandler):
+  @conditional_on_project
+  @prolog(path_components = ['project'], required_level = VIEWER_LEVEL)
+  def get(self, project_key):
+    dashboard, entities, builds = self.dashboard_builds()
+    result = self.project_json(self.project)
+    result.update(revision = dashboard.revision, next_version = dashboard.next_version)
+    for name, builds_of_kind in builds.iteritems():
+      result[name] = [self.build_json(build) for build in builds_of_kind]
+    self.render_json_and_finish(result)
+
+class ApiProjectBuildHandler(ApiHandler):
+  @conditional_on_project
+  @prolog(path_components = ['project', 'build'], required_level = VIEWER_LEVEL)
+  def get(self, project_key, build_key):
+    self.render_json_and_finish(self.build_json(self.build))
+
+class ApiProjectQueueHandler(ApiHandler):
+  @prolog(path_components = ['project'], required_level = VIEWER_LEVEL)
+  def get(self, project_key):
+    dashboard, entities, builds = self.dashboard_builds()
+    queued = []
+    for build in builds['latest_builds']:
+      if build.state != BUILD_QUEUED:
+        continue
+      build.set_active_message(entities.get(dashboard.active_message_of(build.key())))
+      build.calculate_queue_position()
+      item = self.build_json(build)
+      item.update(queue_position = build.queue_position())
+      queued.append(item)
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.render_json_and_finish(dict(queued_builds = queued))
+
+class ApiBuildersHandler(ApiHandler):
+  @prolog(required_level = NORMAL_LEVEL)
+  def get(self):
+    builders = self.fetch_active_builders()
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.render_json_and_finish(dict(
+      builders = [dict(
+        name = builder.name,
+        pool = builder.pool or DEFAULT_POOL,
+        tags = builder.tags,
+        online = builder.is_online(),
+        busy = bool(builder.busy),
+        seconds_since_last_check = int(builder.since_last_check()),
+        queued = builder.message_count(),
+      ) for builder in builders],
+      pools = self.fetch_pools(builders),
+    ))
@@ -2,18 +2,23 @@
 
 import os
 import logging
+import time
 import urllib
 
 from datetime import datetime, timedelta
 from google.appengine.ext.webapp import template
 from google.appengine.api import users
 # from google.appengine.api import memcache
-# from google.appengine.ext import db
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from appengine_utilities.flash import Flash
 
-from tabular import tabularize, untabularize
+from tabular import tabularize, untabularize, tabular_writer
 from builder.models import *
+from builder.dispatch import note_work_changed, note_pool_work_changed, recent_builder_checks
+from builder.caching import get_cached, set_cached
+from builder.transitions import message_control_key
+from builder.stats import name_request, note_time
 
 template_path = os.path.join(os.path.dirname(__file__), '..', '..', 'templates')
 template.register_template_library('myfilters')
@@ -31,6 +36,7 @@ class prolog(object):
 
   def __call__(decor, original_func):
     def decoration(self, *args):
+      started_at = time.time()
       try:
         self.read_flash()
         self.read_config(config_needed = decor.config_needed)
@@ -44,6 +50,7 @@ class prolog(object):
         for func in decor.fetch:
           getattr(self, 'also_fetch_%s' % func)()
         self.elaborate_permissions_for_template()
+        note_time('prolog_ms', started_at)
         return original_func(self, *args)
       except FinishRequest:
         pass
@@ -57,6 +64,10 @@ class BaseHandler(webapp.RequestHandler):
     self.config = None
     self.now = datetime.now()
     self.data = dict(now = self.now)
+
+  def initialize(self, request, response):
+    webapp.RequestHandler.initialize(self, request, response)
+    name_request(self.__class__.__name__, request.method)
     
   def finish_request(self):
     raise FinishRequest
@@ -76,7 +87,7 @@ class BaseHandler(webapp.RequestHandler):
     self._flash.msg = message
     
   def read_config(self, config_needed = True):
-    self.config = config_query.get()
+    self.config = load_config()
     if self.config == None:
       if config_needed:
         self.redirect_and_finish('/server-config',
@@ -92,23 +103,32 @@ class BaseHandler(webapp.RequestHandler):
       self.profile = Profile(user = None, email = None, level = ANONYMOUS_LEVEL)
       self.data.update(username = None, login_url = users.create_login_url(self.request.uri))
     else:
-      self.profile = (Profile.all().filter('user =', self.user).get() or
-        Profile.all().filter('email =', self.user.email()).get() or
-        Profile(user = self.user, email = self.user.email(), level = ANONYMOUS_LEVEL))
+      cache_key = Profile.cache_key_for(self.user.email())
+      self.profile = get_cached(cache_key)
+      cached = (self.profile is not None)
+      if not cached:
+        self.profile = (Profile.all().filter('user =', self.user).get() or
+          Profile.all().filter('email =', self.user.email()).get() or
+          Profile(user = self.user, email = self.user.email(), level = ANONYMOUS_LEVEL))
+      changed = False
       if users.is_current_user_admin() and self.profile.level < GOD_LEVEL:
         # propagate new admins to gods
         self.profile.level = GOD_LEVEL
-        self.profile.put()
+        changed = True
       elif not users.is_current_user_admin() and self.profile.level == GOD_LEVEL:
         # revoke god priveledges from ex-admins
         self.profile.level = ADMIN_LEVEL
-        self.profile.put()
+        changed = True
       if self.profile.email == None:
         self.profile.email = self.user.email()
-        self.profile.put()
+        changed = True
       if self.profile.user == None:
         self.profile.user = self.user
+        changed = True
+      if changed:
         self.profile.put()
+      if changed or not cached:
+        set_cached(cache_key, self.profile)
       self.data.update(username = self.user.nickname(), logout_url = users.create_logout_url(self.request.uri))
     self.data.update(profile = self.profile)
     
@@ -126,8 +146,15 @@ class BaseHandler(webapp.RequestHandler):
     raise FinishRequest
     
   def render_and_finish(self, *path_components):
-    self.response.out.write(template.render(os.path.join(template_path, *path_components), self.data))
+    self.response.out.write(self.render(path_components, self.data))
     raise FinishRequest
+
+  def render(self, path_components, data):
+    started_at = time.time()
+    try:
+      return template.render(os.path.join(template_path, *path_components), data)
+    finally:
+      note_time('render_ms', started_at)
     
   def access_denied(self, message = None, attemp_login = True):
     if attemp_login and self.user == None and self.request.method == 'GET':
@@ -147,20 +174,43 @@ class BaseHandler(webapp.RequestHandler):
     self.data.update(message = message)
     self.render_and_finish('errors', template)
     
+  # the page of the query chosen by the 'cursor' parameter; 'params' are kept in the page links
+  def fetch_requested_page(self, query, size, **params):
+    cursor = self.request.get('cursor')
+    try:
+      entities, next_cursor = fetch_page(query, cursor, size)
+    except (db.BadValueError, db.BadRequestError):
+      self.invalid_request("Invalid page cursor ‘%s’" % cursor)
+    self.data.update(
+      first_page_url = cursor and self.page_url(params),
+      next_page_url = next_cursor and self.page_url(params, cursor = next_cursor))
+    return entities
+
+  def page_url(self, params, **more):
+    params = dict([(name, unicode(value).encode('utf-8')) for name, value in params.items() + more.items() if value])
+    if not params:
+      return self.request.path
+    return "%s?%s" % (self.request.path, urllib.urlencode(sorted(params.items())))
+
   def fetch_active_builders(self):
     result = Builder.all().filter('last_check_at > ', (self.now - timedelta(seconds=self.config.builder_is_recent_within))).fetch(20)
+    checks = recent_builder_checks(result)
     for builder in result:
-      builder.bind_environment(self.config, self.now)
-    for builder in result:
-      count = builder.messages.filter('state =', 0).order('created_at').count(limit = 10)
-      logging.info("count for builder %s: %d" % (builder.name, count))
+      builder.bind_environment(self.config, self.now, checks.get(builder.name))
+    for builder, count in zip(result, fetch_queue_depths(result)):
       builder.set_message_count(count)
     return result
+
+  # the pools of the given builders along with the number of builds queued in each
+  def fetch_pools(self, builders):
+    names = sorted(set([DEFAULT_POOL] + [builder.pool or DEFAULT_POOL for builder in builders]))
+    return [dict(name = name, queued = depth) for name, depth in zip(names, fetch_queue_depths(names))]
     
   def also_fetch_projects(self):
-    self.projects = Project.all().order('name').fetch(1000)
+    query = Project.all().order('name')
     if self.effective_level < VIEWER_LEVEL:
-      self.projects = filter(lambda p : p.is_public, self.projects)
+      query.filter('is_public =', True)
+    self.projects = self.fetch_requested_page(query, PROJECTS_PAGE_SIZE)
     self.data.update(projects = self.projects)
     
   def fetch_project(self, project_component):
@@ -177,7 +227,11 @@ class BaseHandler(webapp.RequestHandler):
     
   def fetch_build(self, build_component):
     build_component = urllib.unquote(build_component)
-    self.build = self.project.builds.filter('version =', build_component).order('-created_at').get()
+    if self.project.versions_reserved:
+      reservation = BuildVersion.get_for(self.project, build_component)
+      self.build = reservation and reservation.build
+    else:
+      self.build = self.project.builds.filter('version =', build_component).order('-created_at').get()
     if self.build == None:
       self.not_found("Build '%s' not found in project '%s'" % (build_component, self.project.name))
     self.data.update(build = self.build)
@@ -189,14 +243,21 @@ class BaseHandler(webapp.RequestHandler):
       self.builder = Builder(name = builder_component)
     self.data.update(builder = self.builder)
     
+  # "pool:<name>" chooses a pool instead of a particular builder
   def also_fetch_builder(self):
-    self.builder = Builder.all().filter('name = ', self.request.get('builder')).get()
-    if self.builder == None:
-      self.not_found("Builder ‘%s’ not found" % self.request.get('builder'))
-    self.data.update(builder = self.builder)
+    self.builder = None
+    self.pool = None
+    choice = self.request.get('builder')
+    if choice.startswith('pool:'):
+      self.pool = choice[len('pool:'):] or DEFAULT_POOL
+    else:
+      self.builder = Builder.all().filter('name = ', choice).get()
+      if self.builder == None:
+        self.not_found("Builder ‘%s’ not found" % choice)
+    self.data.update(builder = self.builder, pool = self.pool)
     
   def also_fetch_profiles(self):
-    self.profiles = Profile.all().fetch(1000)
+    self.profiles = self.fetch_requested_page(Profile.all().order('email'), PROFILES_PAGE_SIZE)
     self.data.update(profiles = self.profiles)
     
   def fetch_profile(self, profile_component):
@@ -209,22 +270,65 @@ class BaseHandler(webapp.RequestHandler):
         self.not_found("No registered user exists for email address “%s”" % profile_component)
     self.data.update(profile = self.profile)
     
-  def start_build(self, version, builder, repo_configuration):
-    repo_configuration_str = tabularize(repo_configuration)
-    
-    build = Build(project = self.project, version = version, builder = builder, created_by = self.user,
-      repo_configuration = repo_configuration_str, state = BUILD_QUEUED,
-      has_server_overrides = repo_configuration.has_overrides())
-    build.put()
+  # the scripts are stored separately (see ScriptRevision) and only referred to by hash;
+  # the version is left out and added by versioned_message_body
+  def message_body(self, repo_configuration_str):
+    parts = []
+    out = tabular_writer(parts.append)
+    out.row('PROJECT', self.project.permalink, self.project.name)
+    if self.config.common_script:
+      out.row('INCLUDE', store_script(self.config.common_script))
+    out.text(repo_configuration_str)
+    out.row('INCLUDE', store_script(self.project.script))
+    return "".join(parts)
 
-    body = "SET\tver\t%s\nPROJECT\t%s\t%s\n%s\n%s\n%s" % (version, self.project.permalink, self.project.name,
-      self.config.common_script, repo_configuration_str, self.project.script)
+  # the build goes either to the builder or, if it is None, to the pool; a build held
+  # until 'hold_until' is not dispatched before that time; returns None if the version already exists
+  def start_build(self, version, builder, repo_configuration, pool = None, priority = PRIORITY_MANUAL, hold_until = None):
+    schedule_version_reservation(self.project)
+    if is_version_taken(self.project, version):
+      return None
+    repo_configuration_str = tabularize(repo_configuration)
+    body = versioned_message_body(version, self.message_body(repo_configuration_str))
 
-    message = Message(builder = builder, build = build, body = body)
-    message.put()
+    if builder is not None:
+      pool = None
+    required_tags = (self.project.required_tags if pool else [])
+    build = create_build(self.project.key(), version, priority,
+      dict(builder = builder, pool = pool, required_tags = required_tags, created_by = self.user,
+        repo_configuration = repo_configuration_str, state = BUILD_QUEUED,
+        has_server_overrides = repo_configuration.has_overrides()),
+      dict(builder = builder, pool = pool, required_tags = required_tags, body = body, hold_until = hold_until))
+    if build is None:
+      return None
+    if builder is None:
+      adjust_queue_depth(pool, +1)
+      note_pool_work_changed(pool)
+    else:
+      adjust_queue_depth(builder, +1)
+      note_work_changed(builder.name)
+    refresh_dashboard(self.project.key(), self.config)
+    return build
+    
+  # merges a continuous build request into the queued continuous build of the project;
+  # returns that build, or None if there is none and a new one has to be started
+  def coalesce_continuous_build(self, repo_configuration):
+    repo_configuration_str = tabularize(repo_configuration)
+    # storing the scripts may start transactions of its own, so it cannot happen inside the merge
+    body = self.message_body(repo_configuration_str)
+    return merge_into_queued_continuous_build(self.project.key(), repo_configuration_str, body, self.config, self.now)
     
+  # the message must have been given to self.builder
+  def fetch_own_message(self, message_key):
+    self.message = Message.get(message_key)
+    if self.message == None:
+      self.not_found("No message found with key %s" % message_key)
+    if Message.builder.get_value_for_datastore(self.message) != self.builder.key():
+      self.invalid_request("The chosen message %s belongs to another builder" % message_key)
+    return self.message
+
   def get_message_control(self, message_key):
-    result = memcache.get("control-%s" % message_key)
+    result = memcache.get(message_control_key(message_key))
     if result is None:
       if not hasattr(self, 'message'):
         self.message = Message.get(message_key)
@@ -232,11 +336,6 @@ class BaseHandler(webapp.RequestHandler):
         result = 'ABORT'
       else:
         result = 'OK'
-      memcache.add("control-%s" % message_key, result)
+      memcache.add(message_control_key(message_key), result)
     return result
 
-  def invalidate_message_control(self, message_key):
-    memcache.delete("control-%s" % message_key)
-    
-  def update_message_console(self, message_key, console):
-    memcache.set("progress-%s" % message_key, console, time = 60*60)
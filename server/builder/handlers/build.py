@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import cgi
 import logging
+import time
+import urllib
 
 from datetime import datetime, timedelta
 from google.appengine.api import memcache
@@ -8,6 +11,12 @@ from google.appengine.ext import db
 
 from builder.models import *
 from builder.handlers.base import prolog, BaseHandler
+from builder.dispatch import current_work_generation, note_work_changed, remember_idle, cached_idle_marker, record_builder_check
+from builder.dispatch import wait_for_work, LONG_POLL_MAX_WAIT
+from builder.caching import set_cached
+from builder.console import append_console, flush_console, finish_console, read_console
+from builder.transitions import abort_builds, abandon_builds, abandon_messages
+from builder.transport import compressed_transport
 
 from tabular import tabularize, untabularize
 from builder.data.perproject import script_info
@@ -19,6 +28,14 @@ class ProjectBuildHandler(BaseHandler):
     self.build.calculate_time_deltas(self.now)
     self.build.calculate_derived_data()
     self.build.calculate_active_message()
+    self.build.calculate_eta(self.now, load_duration_stats(self.project.key())[0])
+    try:
+      log_page = int(self.request.get('log_page'))
+    except ValueError:
+      log_page = None
+    self.build.calculate_console(log_page)
+    revision = project_revision(self.project.key())
+    self.data.update(revision = revision and revision[0], live_fragment = 'summary')
     self.render_and_finish('project', 'buildinfo.html')
 
 class BuildProjectHandler(BaseHandler):
@@ -30,12 +47,6 @@ class BuildProjectHandler(BaseHandler):
       self.error(500)
       return
       
-    existing_count = self.project.builds.filter('version =', version).count()
-    if existing_count > 0:
-      logging.info("Ignoring build request with the same version number (%s, project %s)" % (version, self.project.name))
-      self.redirect_and_finish('/projects/%s' % self.project.urlname(),
-        flash = "Version %s already exists. Please pick another." % version)
-
     script_info = self.project.script_info()
     repo_configuration = repo_configuration_info()
     for repos in script_info.alternable_repositories:
@@ -53,10 +64,15 @@ class BuildProjectHandler(BaseHandler):
         self.redirect_and_finish('/projects/%s' % self.project.urlname(),
           flash = "Sorry, location %s is no longer available for repository %s." % (chosen_location_name, repos.name))
 
-    self.start_build(version, self.builder, repo_configuration)
+    if self.start_build(version, self.builder, repo_configuration, pool = self.pool) is None:
+      logging.info("Ignoring build request with the same version number (%s, project %s)" % (version, self.project.name))
+      self.redirect_and_finish('/projects/%s' % self.project.urlname(),
+        flash = "Version %s already exists. Please pick another." % version)
     
     self.profile.last_used_builder = self.builder
+    self.profile.last_used_pool = self.pool
     self.profile.put()
+    set_cached(Profile.cache_key_for(self.profile.email), self.profile)
         
     update_or_insert(ProfileProjectPreferences, dict(profile = self.profile, project = self.project),
       repository_choices = tabularize(repo_configuration.without_default_choices()),
@@ -65,6 +81,9 @@ class BuildProjectHandler(BaseHandler):
     self.redirect_and_finish('/projects/%s' % self.project.urlname(),
       flash = "Started bulding version %s. Please refresh this page to track status." % version)
 
+# how many successive versions a continuous build tries when racing another build
+CONTINUOUS_VERSION_ATTEMPTS = 5
+
 class StartContinuousBuildProjectHandler(BaseHandler):
   @prolog(path_components = ['project'])
   def post(self, project_key):
@@ -74,62 +93,54 @@ class StartContinuousBuildProjectHandler(BaseHandler):
       self.access_denied("Invalid token", attemp_login = False)
       
     builder = self.project.continuous_builder
-    logging.info('token ok; builder is %s' % builder)
-    if builder == None:
+    pool = self.project.continuous_pool
+    logging.info('token ok; builder is %s, pool is %s' % (builder, pool))
+    if not self.project.has_continuous_builds():
       self.not_found("Continuous builds are disabled for this project")
 
-    latest_build = self.project.builds.order('-created_at').get()
-    version = calculate_next_version(latest_build)
-    logging.info('builder ok; version is %s' % version)
+    # scripts rebuilding old revisions pass priority=backfill to stay out of everyone's way
+    if self.request.get('priority') == priority_names[PRIORITY_BACKFILL]:
+      priority = PRIORITY_BACKFILL
+    else:
+      priority = PRIORITY_CONTINUOUS
 
-    existing_count = self.project.builds.filter('version =', version).count()
-    if existing_count > 0:
-      logging.info("Ignoring build request with the same version number (%s, project %s)" % (version, self.project.name))
-      self.error(400)
-      return
-      
     script_info = self.project.script_info()
     repo_configuration = repo_configuration_info()
     for repos in script_info.alternable_repositories:
       repo_configuration.set(repos.name, 'default', repos.locations[0].name)
 
-    self.start_build(version, builder, repo_configuration)
+    if priority == PRIORITY_CONTINUOUS:
+      # the queued build will pick up whatever the new trigger was about
+      queued_build = self.coalesce_continuous_build(repo_configuration)
+      if queued_build is not None:
+        logging.info("Merged into the queued build %s (project %s)" % (queued_build.version, self.project.name))
+        self.response.out.write("OK\t%s" % queued_build.version)
+        return
+      hold_until = continuous_hold_until(self.config, self.now)
+    else:
+      hold_until = None
+
+    version = latest_version(self.project)
+    for attempt in range(CONTINUOUS_VERSION_ATTEMPTS):
+      version = calculate_next_version(version)
+      if version is None:
+        self.invalid_request("Cannot derive the next version from %s (project %s)" % (latest_version(self.project), self.project.name))
+      logging.info('builder ok; version is %s' % version)
+      if self.start_build(version, builder, repo_configuration, pool = pool, priority = priority, hold_until = hold_until) is not None:
+        break
+      logging.info("Version %s is already taken (project %s)" % (version, self.project.name))
+    else:
+      self.error(400)
+      return
 
     self.response.out.write("OK\t%s" % version)
     
   get = post
   
-@transaction
-def set_build_to_aborted(build_key):
-  build = Build.get(build_key)
-  if build.state in [BUILD_FAILED, BUILD_SUCCEEDED, BUILD_ABANDONED, BUILD_ABORTED]:
-    return False
-  build.state = BUILD_ABORTED
-  build.put()
-  return True
-  
-@transaction
-def set_message_to_aborted(message_key):
-  message = Message.get(message_key)
-  if message.state in [MESSAGE_DONE, MESSAGE_ABANDONED, MESSAGE_ABORTED]:
-    return False
-  message.state = MESSAGE_ABORTED
-  message.put()
-  return True
-
 class AbortProjectBuildHandler(BaseHandler):
   @prolog(path_components = ['project', 'build'], required_level = NORMAL_LEVEL)
   def post(self, project_key, build_key):
-    anything_done = set_build_to_aborted(self.build.key())
-    
-    messages = self.build.messages.filter('state =', MESSAGE_INPROGRESS).fetch(100)
-    messages += self.build.messages.filter('state =', MESSAGE_QUEUED).fetch(100)
-    for message in messages:
-      anything_done = set_message_to_aborted(message.key()) or anything_done
-      memcache.delete("progress-%s" % message.key())
-      self.invalidate_message_control(message.key())
-    
-    if anything_done:
+    if abort_builds([self.build], self.config):
       self.redirect_and_finish('/projects/%s' % self.project.urlname(),
         flash = "Aborted bulding of version %s." % self.build.version)
     else:
@@ -138,97 +149,290 @@ class AbortProjectBuildHandler(BaseHandler):
     
   get = post
 
+# a builder normally has at most one message in progress, so this only bounds the cleanup
+ORPHANS_PER_POLL = 10
+
+# a build running this many times longer than the 90th percentile of recent builds is
+# considered abandoned even if build_abandoned_after has not passed yet
+ABANDON_AFTER_P90_RUNS = 3
+
+# how many queued builds a builder looks at when choosing one to take
+PINNED_CANDIDATES = 3
+POOL_CANDIDATES = 10
+
 class BuilderObtainWorkHandler(BaseHandler):
-  def get(self):
-    self.post()
-    
-  @prolog(path_components = ['builder'])
+  @compressed_transport
   def post(self, name):
-    message = None
-    if self.builder.is_saved():
-      # handle stale messages
-      stale_messages = self.builder.messages.filter('state =', MESSAGE_INPROGRESS).filter('created_at <', (self.now - timedelta(seconds = 60*60))).order('created_at').fetch(100)
-      for message in stale_messages:
-        message.abandon_and_put()
-        
-      # handle stale builds
-      stale_builds = Build.all().filter('builder =', self.builder).filter('state =', BUILD_INPROGRESS).fetch(1000)
-      logging.info("found %d stale build(s)" % len(stale_builds))
-      for build in stale_builds:
-        build.abandon_and_put()
-        
-      # check for selfupdate request
-      if self.builder.self_update_requested:
-        self.builder.self_update_requested = False
-        self.builder.put()
-        self.response.out.write("SELFUPDATE\tv1")
-        self.finish_request()
+    # idle polls are answered from memcache without touching the datastore;
+    # builders passing 'wait' are held until work is queued for them
+    builder_name = urllib.unquote(name)
+    deadline = self.long_poll_deadline()
+    capabilities = self.reported_capabilities()
+    pool = capabilities[0]
+    while True:
+      marker = cached_idle_marker(builder_name, pool, capabilities)
+      if marker is None:
+        marker = self.obtain_work(name)
+      else:
+        record_builder_check(builder_name, datetime.now())
+      if marker is None:
+        return
+      generation, idle_response = marker
+      if deadline is None or generation is None:
+        # without the work generation (memcache is unavailable) there is nothing to wait on,
+        # and the builder has to sleep between polls as usual
+        self.response.out.write(idle_response)
+        return
+      if not wait_for_work(builder_name, pool, generation, deadline):
+        self.response.out.write("%s\tLONGPOLL" % idle_response)
+        return
+      # the handler's clock was read before the wait and would date the dispatch too early
+      self.now = datetime.now()
+      self.data.update(now = self.now)
     
-      # retrieve the next message to process
-      message = self.builder.messages.filter('state =', 0).order('created_at').get()
+  get = post
+    
+  @prolog(path_components = ['builder'])
+  def obtain_work(self, name):
+    capabilities = self.reported_capabilities()
+    pool, tags = capabilities
+    generation = current_work_generation(self.builder.name, pool)
+    self.builder.pool = pool
+    self.builder.tags = list(tags)
+    if not self.builder.is_saved():
+      self.builder.put()
+
+    # a builder asking for work is no longer running what it was given before;
+    # builders that vanished altogether are taken care of by the sweeper
+    orphaned_messages = self.builder.messages.filter('state =', MESSAGE_INPROGRESS).fetch(ORPHANS_PER_POLL)
+    if orphaned_messages:
+      orphaned_builds = [build for build in db.get([Message.build.get_value_for_datastore(message) for message in orphaned_messages])
+        if build is not None and build.state == BUILD_INPROGRESS]
+      abandon_builds(orphaned_builds, self.config)
+      abandon_messages(orphaned_messages, self.config)
       
+    # check for selfupdate request
+    if self.builder.self_update_requested:
+      self.builder.self_update_requested = False
+      self.builder.put()
+      self.response.out.write("SELFUPDATE\tv1")
+      self.finish_request()
+  
+    # builds pinned to this builder come first, then the ones of its pool
+    deadline_at = self.now + timedelta(seconds = self.config.build_abandoned_after)
+    self.held_work = False
+    self.skipped_work = False
+    message = self.claim_next(builder_candidates(self.builder, PINNED_CANDIDATES), deadline_at)
+    if message is None:
+      message = self.claim_from_pool(pool, deadline_at)
+      
+    marker = None
     if message == None:
-      self.response.out.write("IDLE\tv1\t%d" % self.config.builder_poll_interval)
       self.builder.busy = False
+      marker = (generation, "IDLE\tv1\t%d" % self.config.builder_poll_interval)
     else:
-      message.state = MESSAGE_INPROGRESS
-      message.put()
       build = message.build
+      project_key = Build.project.get_value_for_datastore(build)
+      build.builder = self.builder
       build.state = BUILD_INPROGRESS
+      build.dispatched_at = self.now
+      build.deadline_at = deadline_at
+      self.estimate_run_time(build, message, project_key)
       build.put()
+      refresh_dashboard_quietly(project_key, self.config)
+      self.builder.note_warm_project(project_key)
       self.builder.busy = True
-      body = "ENVELOPE\tv1\t%s\n%s" % (message.key(), message.body)
+      body = message.body
+      if not self.request.get('includes'):
+        # this builder does not know how to fetch the scripts
+        body = expand_includes(body)
+      body = "ENVELOPE\tv1\t%s\n%s" % (message.key(), body)
       self.response.out.write(body)
       
     self.builder.last_check_at = datetime.now()
     self.builder.put()
+    record_builder_check(self.builder.name, self.builder.last_check_at)
+    if marker is not None and not self.held_work and not self.skipped_work:
+      # held builds become available without a queue change, so such idleness cannot be cached;
+      # nor is it cached when builds were passed over for their required tags
+      remember_idle(self.builder.name, marker[0], marker[1], capabilities)
+    return marker
+
+  # takes the first candidate this builder can run; with affinity, the builds of projects
+  # the builder has recently built (and so has warm checkouts of) go first, but never
+  # ahead of a build with a higher priority
+  def claim_next(self, candidates, deadline_at, affinity = False):
+    held = [message for message in candidates if message.is_held(self.now)]
+    if held:
+      self.held_work = True
+    if [message for message in candidates if not self.builder.can_run(message)]:
+      self.skipped_work = True
+    eligible = [message for message in candidates if self.builder.can_run(message) and not message.is_held(self.now)]
+    if affinity and eligible:
+      warm = set(self.builder.warm_projects)
+      preferred = [message for message in eligible if message.priority == eligible[0].priority and
+        Message.project.get_value_for_datastore(message) in warm]
+      preferred_keys = set([message.key() for message in preferred])
+      eligible = preferred + [message for message in eligible if message.key() not in preferred_keys]
+    for message in eligible:
+      queue = queue_of(message)
+      claimed = claim_message(message.key(), self.builder.key(), deadline_at)
+      if claimed is not None:
+        adjust_queue_depth(queue, -1)
+        return claimed
+    return None
+
+  # the pool's queue is read page by page until a build this builder can run turns up,
+  # so builds needing tags it lacks cannot hide the ones behind them
+  def claim_from_pool(self, pool, deadline_at):
+    cursor = None
+    while True:
+      candidates, cursor = pool_candidates(pool, cursor, POOL_CANDIDATES)
+      message = self.claim_next(candidates, deadline_at, affinity = True)
+      if message is not None or cursor is None:
+        return message
+
+  # the build is expected to take as long as the recent builds of its project did, or,
+  # for a project that has none, as long as the recent builds of this builder did;
+  # builds that usually run longer than build_abandoned_after get more time before the
+  # sweeper abandons them
+  def estimate_run_time(self, build, message, project_key):
+    project_stats, builder_stats = load_duration_stats(project_key, self.builder.key())
+    stats = project_stats
+    if stats is None or not stats.run_times:
+      stats = builder_stats
+    if stats is None or not stats.run_times:
+      return
+    build.expected_finish_at = self.now + timedelta(seconds = stats.mean_run)
+    deadline_at = self.now + timedelta(seconds = stats.p90_run * ABANDON_AFTER_P90_RUNS)
+    if deadline_at > build.deadline_at:
+      build.deadline_at = message.deadline_at = deadline_at
+      message.put()
+
+  # (pool, tags) as told by the builder
+  def reported_capabilities(self):
+    return (self.request.get('pool') or DEFAULT_POOL, tuple(parse_tags(self.request.get('tags'))))
     
-@transaction
+  def long_poll_deadline(self):
+    try:
+      wait = int(self.request.get('wait') or 0)
+    except ValueError:
+      wait = 0
+    if wait <= 0:
+      return None
+    return time.time() + min(wait, LONG_POLL_MAX_WAIT)
+    
+# a report of None keeps whatever has been appended with BuilderReportHandler
 def update_build_state_as_reported_by_builder(build_key, new_state, report, failure_reason = None):
+  if report is None:
+    artifacts_tab = None
+  else:
+    artifacts_tab = db.Text(tabularize(index_report(report)))
+  return save_build_state_as_reported_by_builder(build_key, new_state, report, artifacts_tab, failure_reason)
+
+@transaction
+def save_build_state_as_reported_by_builder(build_key, new_state, report, artifacts_tab, failure_reason = None):
   build = Build.get(build_key)
   build.state = new_state
+  build.finished_at = datetime.now()
   build.failure_reason = failure_reason
-  build.report = report
+  if report is not None:
+    build.report = report
+    build.artifacts_tab = artifacts_tab
+  elif build.artifacts_tab is None:
+    build.artifacts_tab = db.Text(tabularize(index_report(build.report)))
   build.put()
+  return build
+
+# records with a sequence number that has already been applied are ignored,
+# so a builder may safely resend a batch it is unsure about
+@transaction
+def append_build_report(build_key, seq, records):
+  build = Build.get(build_key)
+  if seq <= (build.report_seq or 0):
+    return False
+  # only the new records are read, into the index of what has been reported so far
+  index = untabularize(report_info(build.artifact_index()), records).index
+  if build.report and not build.report.endswith("\n"):
+    records = "\n" + records
+  build.report = db.Text((build.report or '') + records)
+  build.report_seq = seq
+  build.artifacts_tab = db.Text(tabularize(index))
+  build.put()
+  return True
+
+# receives report records (STORE/ITEM/INSTORE/ACCESS lines) while the build is running
+class BuilderReportHandler(BaseHandler):
+  @compressed_transport
+  @prolog(path_components = ['builder'])
+  def post(self, name, message_key):
+    message = self.fetch_own_message(message_key)
+    if message.state != MESSAGE_INPROGRESS:
+      self.invalid_request("The message %s is not in progress" % message_key)
+    try:
+      seq = int(self.request.get('seq'))
+    except ValueError:
+      self.invalid_request("The sequence number of the report records is missing")
+    append_build_report(Message.build.get_value_for_datastore(message), seq, self.request.get('records'))
+    self.response.out.write(self.get_message_control(message_key))
 
 class BuilderMessageDoneHandler(BaseHandler):
+  @compressed_transport
   @prolog(path_components = ['builder'])
   def post(self, name, message_key):
-    report = self.request.get('report')
-    if report == None:
-      logging.warning("message done handler is called with empty report")
-      report = ''
+    # builders that have streamed the report as it was produced only send the outcome
+    if 'report' in self.request.arguments():
+      report = self.request.get('report')
+    else:
+      report = None
 
     self.builder.last_check_at = datetime.now()
     self.builder.put()
     
-    message = Message.get(message_key)
-    if message == None:
-      self.not_found("No message found with key %s" % message_key)
-    if message.builder.key() != self.builder.key():
-      self.invalid_request("The chosen message %s belongs to another builder" % message_key)
+    message = self.fetch_own_message(message_key)
 
     message.state = MESSAGE_DONE
+    message.console_pages = flush_console(message_key)
     message.put()
     
     build = message.build
     
     outcome = self.request.get("outcome")
     if outcome == 'ERR':
-      update_build_state_as_reported_by_builder(build.key(), BUILD_FAILED, report = report, failure_reason = self.request.get("failure_reason"))
+      build = update_build_state_as_reported_by_builder(build.key(), BUILD_FAILED, report = report, failure_reason = self.request.get("failure_reason"))
     elif outcome == 'SUCCESS':
-      update_build_state_as_reported_by_builder(build.key(), BUILD_SUCCEEDED, report = report)
+      build = update_build_state_as_reported_by_builder(build.key(), BUILD_SUCCEEDED, report = report)
     elif outcome == 'ABORTED':
-      update_build_state_as_reported_by_builder(build.key(), BUILD_ABORTED, report = report)
+      build = update_build_state_as_reported_by_builder(build.key(), BUILD_ABORTED, report = report)
     else:
-      update_build_state_as_reported_by_builder(build.key(), BUILD_FAILED, report = report, failure_reason = "Illegal outcome %s" % outcome)
+      build = update_build_state_as_reported_by_builder(build.key(), BUILD_FAILED, report = report, failure_reason = "Illegal outcome %s" % outcome)
+    if build.state in (BUILD_SUCCEEDED, BUILD_FAILED):
+      record_build_durations(build)
+    refresh_dashboard_quietly(Build.project.get_value_for_datastore(build), self.config)
 
-    self.update_message_console(message_key, "FIN")
+    finish_console(message_key)
+
+# the scripts never change, so builders and proxies may cache them forever
+class ScriptHandler(BaseHandler):
+  @compressed_transport
+  def get(self, script_hash):
+    scripts = load_scripts([script_hash])
+    if script_hash not in scripts:
+      self.error(404)
+      return
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.headers['Cache-Control'] = 'public, max-age=31536000'
+    self.response.out.write(scripts[script_hash])
 
 class ReportProgressHandler(BaseHandler):
+  @compressed_transport
   def post(self, message_key):
-    console = self.request.get('console')
-    self.update_message_console(message_key, console)
+    arguments = self.request.arguments()
+    if 'append' in arguments:
+      append_console(message_key, self.request.get('append'))
+    elif 'console' in arguments:
+      # builders predating incremental reporting send the whole console every time
+      append_console(message_key, self.request.get('console'), replace = True)
     
     control = self.get_message_control(message_key)
     self.response.out.write(control)
@@ -242,15 +446,23 @@ class ReportProgressHandler(BaseHandler):
     
   get = post
 
+# responds with a "<new offset>\t<mode>" line followed by the console output after the given chunk offset
 class MessageConsoleHandler(BaseHandler):
+  @compressed_transport
   def post(self, message_key):
-    key = "progress-%s" % (message_key)
-    value = memcache.get(key)
-    if value is None:
-      self.response.out.write("Waiting for log from the builder...")
-    elif value == "FIN":
-      self.response.out.write("<script>reload_page()</script>Reloading page...")
+    try:
+      offset = int(self.request.get('offset') or 0)
+    except ValueError:
+      offset = 0
+    delta = read_console(message_key, max(0, offset))
+    if delta.finished:
+      mode = 'FIN'
+    elif delta.waiting:
+      mode = 'WAIT'
+    elif delta.reset:
+      mode = 'R'
     else:
-      self.response.out.write("%s" % value)
+      mode = 'A'
+    self.response.out.write("%d\t%s\n%s" % (delta.offset, mode, cgi.escape(delta.text)))
       
   get = post
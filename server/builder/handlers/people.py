@@ -8,6 +8,7 @@ from google.appengine.ext import db
 
 from builder.models import *
 from builder.handlers.base import prolog, BaseHandler
+from builder.caching import invalidate_cached
 
 class PeopleHandler(BaseHandler):
   @prolog(fetch = ['profiles'], required_level = ADMIN_LEVEL)
@@ -24,6 +25,7 @@ class CrudePersonHandler(BaseHandler):
     if self.profile.is_saved and self.request.get('delete'):
       if self.request.get('confirm'):
         self.profile.delete()
+        invalidate_cached(Profile.cache_key_for(self.profile.email))
         self.redirect_and_finish('/people',
           flash = "%s is deleted." % self.profile.email)
       else:
@@ -32,12 +34,14 @@ class CrudePersonHandler(BaseHandler):
       
     if not self.profile.is_saved():
       self.profile.invited_by = self.user
+    previous_email = self.profile.email
     self.profile.email = self.request.get('email')
     self.profile.level = int(self.request.get('level'))
 
     # errors = self.profile.validate()
     # if len(errors) == 0:
     self.profile.put()
+    invalidate_cached(Profile.cache_key_for(previous_email), Profile.cache_key_for(self.profile.email))
     self.redirect_and_finish('/people',
       flash = ("%s saved." if self.profile.is_saved() else "%s added.") % self.profile.email)
     # else:
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import cgi
 import logging
+import time
 
 from datetime import datetime, timedelta
+from django.utils import simplejson
 from google.appengine.api import memcache
 from google.appengine.ext import db
 
+from tabular import untabularize
 from builder.models import *
 from builder.handlers.base import prolog, BaseHandler
+from builder.console import read_console
+from builder.dispatch import LONG_POLL_MAX_WAIT
+from builder.live import wait_for_updates
+from builder.data.live_updates import watch_list_info
 
 from builder.utils import create_token
 from builder.data.chosen_repos import repo_configuration_info
@@ -21,10 +29,20 @@ class CreateEditProjectHandler(BaseHandler):
   def post(self, project_key):
     if not self.project.is_saved():
       self.project.owner = self.user
+      # a new project has no builds that would need reserving
+      self.project.versions_reserved = True
+    previous_permalink = self.project.permalink
     self.project.name = self.request.get('project_name')
     self.project.script = self.request.get('project_script')
     self.project.permalink = self.request.get('project_permalink')
-    self.project.continuous_builder = Builder.all().filter('name =', self.request.get('project_continuous_builder')).get()
+    continuous_choice = self.request.get('project_continuous_builder')
+    if continuous_choice.startswith('pool:'):
+      self.project.continuous_builder = None
+      self.project.continuous_pool = continuous_choice[len('pool:'):] or DEFAULT_POOL
+    else:
+      self.project.continuous_builder = Builder.all().filter('name =', continuous_choice).get()
+      self.project.continuous_pool = None
+    self.project.required_tags = parse_tags(self.request.get('project_required_tags'))
     
     if self.project.continuous_token == None:
       self.project.continuous_token = create_token()
@@ -33,13 +51,16 @@ class CreateEditProjectHandler(BaseHandler):
     if len(errors) == 0:
       self.project.derive_info_from_script(self.config.common_script)
       self.project.put()
+      invalidate_project_stub(previous_permalink, self.project.permalink)
+      refresh_dashboard(self.project.key(), self.config)
       self.redirect('/projects/%s' % self.project.urlname())
     else:       
       self.render_editor(errors)          
 
   def render_editor(self, errors = dict()):
     builders = self.fetch_active_builders()
-    self.data.update(errors = errors, edit = self.project.is_saved(), builders = builders)
+    self.data.update(errors = errors, edit = self.project.is_saved(), builders = builders,
+      pools = self.fetch_pools(builders))
     self.render_and_finish('project', 'editor.html')
     
     # used_repositories = self._calculate_used_repositories(self.project.script)
@@ -63,7 +84,9 @@ class DeleteProjectHandler(BaseHandler):
       self.redirect('/projects/%s/edit' % self.project.urlname())
       return
 
-    self.project.delete()
+    db.delete([self.project, db.Key.from_path('ProjectDashboard', ProjectDashboard.key_for(self.project))])
+    invalidate_project_stub(self.project.permalink)
+    memcache.delete(project_revision_key(self.project.key()))
     self.redirect('/projects')
 
 class ProjectHandler(BaseHandler):
@@ -90,31 +113,35 @@ class ProjectHandler(BaseHandler):
         else:
           repos.chosen_one = 'default'
       
+      for builder, durations in zip(builders, load_duration_stats(*[builder.key() for builder in builders])):
+        builder.durations = durations
       self.data.update(online_builders = online_builders, recent_builders = recent_builders,
-        builders = online_builders + recent_builders, last_used_builder = last_used_builder)
+        builders = online_builders + recent_builders, last_used_builder = last_used_builder,
+        pools = self.fetch_pools(builders), last_used_pool = self.profile.last_used_pool)
     
     num_latest = self.config.num_latest_builds
     num_recent = self.config.num_recent_builds
-    builds = self.project.builds.order('-created_at').fetch(max(num_latest, num_recent))
+    dashboard = load_dashboard(self.project, self.config)
+    entities = dict([(e.key(), e) for e in db.get(dashboard.all_keys()) if e is not None])
+    latest_builds = [entities[k] for k in dashboard.latest_builds if entities.has_key(k)]
+    recent_builds = [entities[k] for k in dashboard.recent_builds if entities.has_key(k)]
+    successful_builds = [entities[k] for k in dashboard.successful_builds if entities.has_key(k)]
+    builds = latest_builds + recent_builds + successful_builds
+    prefetch_references(builds, Build.builder)
     for build in builds:
       build.calculate_time_deltas(self.now)
-    for build in builds:
-      build.check_abandoning(self.config.build_abandoned_after)
     
-    latest_builds = builds[0:num_latest]
-    recent_builds = builds[0:num_recent]
+    if latest_builds:
+      latest_builds[0].is_newest = True
+    durations = load_duration_stats(self.project.key())[0]
     for build in latest_builds:
       build.calculate_derived_data()
-      build.calculate_active_message()
+      build.set_active_message(entities.get(dashboard.active_message_of(build.key())))
+      build.calculate_queue_position()
+      build.calculate_eta(self.now, durations)
       
-    recent_builds = filter(lambda build: build.state != BUILD_SUCCEEDED, recent_builds)
-
     num_successful = num_recent
-    successful_builds = self.project.builds.filter('state =', BUILD_SUCCEEDED).order('-created_at').fetch(num_successful)
-    for build in successful_builds:
-      build.calculate_time_deltas(self.now)
-
-    next_version = calculate_next_version(builds[0] if builds else None)
+    next_version = dashboard.next_version
     
     self.data.update(
       latest_builds = latest_builds,
@@ -124,5 +151,109 @@ class ProjectHandler(BaseHandler):
       num_recent_builds = num_recent,
       num_successful = num_successful,
       next_version = next_version,
+      revision = dashboard.revision,
+      live_fragment = 'latest',
+      durations = durations,
     )
     self.render_and_finish('project', 'index.html')
+
+class ProjectHistoryHandler(BaseHandler):
+
+  @prolog(path_components = ['project'], required_level = VIEWER_LEVEL)
+  def get(self, project_key):
+    state_name = self.request.get('state')
+    states = dict([(info['name'], state) for state, info in state_info.iteritems()])
+    if state_name and not states.has_key(state_name):
+      self.invalid_request("Unknown build state ‘%s’" % state_name)
+    state = states.get(state_name)
+
+    builder_name = self.request.get('builder')
+    builder = None
+    if builder_name:
+      builder = Builder.all().filter('name =', builder_name).get()
+      if builder is None:
+        self.not_found("Builder ‘%s’ not found" % builder_name)
+
+    builds = self.fetch_requested_page(build_history_query(self.project, state, builder),
+      HISTORY_PAGE_SIZE, state = state_name, builder = builder_name)
+    prefetch_references(builds, Build.builder)
+    for build in builds:
+      build.calculate_time_deltas(self.now)
+
+    self.data.update(
+      builds = builds,
+      state_names = [state_info[s]['name'] for s in sorted(state_info.keys())],
+      chosen_state = state_name,
+      chosen_builder = builder_name,
+    )
+    self.render_and_finish('project', 'history.html')
+
+# the parts of the pages that are replaced when a build changes its state
+live_fragments = {
+  'latest': '_latest_build.html',
+  'summary': '_build_summary.html',
+}
+
+# answers with the console output and the state changes of the builds the page shows;
+# with 'wait', holds the request until there is something to tell
+class ProjectUpdatesHandler(BaseHandler):
+
+  @prolog(path_components = ['project'], required_level = VIEWER_LEVEL)
+  def post(self, project_key):
+    watch_list = untabularize(watch_list_info(), self.request.get('watch'))
+    deadline = time.time()
+    if self.request.get('wait'):
+      deadline += LONG_POLL_MAX_WAIT
+    revision_changed, consoles = wait_for_updates(self.project.key(), watch_list, deadline)
+
+    updates = dict()
+    if revision_changed:
+      for watch, build in zip(watch_list.watches, self.fetch_watched_builds(watch_list)):
+        if build is None or build.state_name() == watch.state:
+          continue
+        update = updates.setdefault(watch.build_key, dict(build = watch.build_key))
+        update.update(state = build.state_name())
+        if live_fragments.has_key(watch.fragment):
+          update.update(html = self.render_fragment(build, watch.fragment))
+    for watch in consoles:
+      delta = read_console(watch.message_key, watch.offset)
+      if delta.finished:
+        mode = 'FIN'
+      elif delta.waiting:
+        mode = 'WAIT'
+      elif delta.reset:
+        mode = 'R'
+      else:
+        mode = 'A'
+      update = updates.setdefault(watch.build_key, dict(build = watch.build_key))
+      update.update(offset = delta.offset, mode = mode, text = cgi.escape(delta.text))
+
+    revision = project_revision(self.project.key())
+    self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.out.write(simplejson.dumps(dict(
+      revision = revision and revision[0],
+      builds = updates.values())))
+
+  # the builds of this project in the order of the watches, None for the others
+  def fetch_watched_builds(self, watch_list):
+    try:
+      keys = [db.Key(watch.build_key) for watch in watch_list.watches]
+    except db.BadKeyError:
+      self.invalid_request("Invalid build key")
+    builds = db.get(keys)
+    prefetch_references([build for build in builds if build is not None], Build.builder)
+    return [build if build is not None and Build.project.get_value_for_datastore(build) == self.project.key() else None
+      for build in builds]
+
+  def render_fragment(self, build, fragment):
+    if fragment == 'latest':
+      # the newest build shows its whole failure reason, as on the project page
+      dashboard = load_dashboard(self.project, self.config)
+      build.is_newest = (dashboard.latest_builds[:1] == [build.key()])
+    build.calculate_time_deltas(self.now)
+    build.calculate_derived_data()
+    build.calculate_active_message()
+    build.calculate_queue_position()
+    build.calculate_eta(self.now, load_duration_stats(self.project.key())[0])
+    return self.render(('project', live_fragments[fragment]), dict(self.data, build = build, live_fragment = fragment))
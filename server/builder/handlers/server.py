@@ -8,6 +8,8 @@ from google.appengine.ext import db
 
 from builder.models import *
 from builder.handlers.base import prolog, BaseHandler
+from builder.transitions import request_self_update
+from builder.stats import load_stats, STATS_WINDOW, STATS_WINDOWS
 
 class SelfUpdateRequestHandler(BaseHandler):
   
@@ -17,9 +19,7 @@ class SelfUpdateRequestHandler(BaseHandler):
       self.redirect_and_finish('/projects', flash = "Please confirm self-update by checking the box.")
       
     builders = Builder.all().order('-last_check_at').fetch(100)
-    for builder in builders:
-      builder.self_update_requested = True
-      builder.put()
+    request_self_update(builders)
       
     self.redirect_and_finish('/projects',
       flash = "Requested self-update of the following builders: %s." % ', '.join(map(lambda b: b.name, builders)))
@@ -34,6 +34,7 @@ class ServerConfigHandler(BaseHandler):
     if self.request.get('delete'):
       if self.config.is_saved():
         self.config.delete()
+        invalidate_config()
       self.redirect('/')
       return
       
@@ -44,12 +45,20 @@ class ServerConfigHandler(BaseHandler):
     self.config.num_latest_builds = int(self.request.get('num_latest_builds'))
     self.config.num_recent_builds = int(self.request.get('num_recent_builds'))
     self.config.build_abandoned_after = int(self.request.get('build_abandoned_after'))
+    self.config.continuous_debounce = int(self.request.get('continuous_debounce') or 0)
     self.config.common_script = self.request.get('common_script')
     if len(self.config.server_name) == 0:
       self.show_editor()
       
     self.config.put()
+    invalidate_config()
     self.redirect('/')
 
   def show_editor(self):      
     self.render_and_finish('server-config', 'editor.html')
+
+class StatsHandler(BaseHandler):
+  @prolog(config_needed = False, required_level = ADMIN_LEVEL)
+  def get(self):
+    self.data.update(routes = load_stats(), minutes = STATS_WINDOW * STATS_WINDOWS / 60)
+    self.render_and_finish('stats', 'index.html')
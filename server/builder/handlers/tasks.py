@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from datetime import datetime
+try:
+  from google.appengine.api import taskqueue
+except ImportError:
+  from google.appengine.api.labs import taskqueue
+
+from builder.models import *
+from builder.handlers.base import BaseHandler
+from builder.sweeper import sweep_expired
+
+# started by cron and continued through the task queue while there is a backlog;
+# /tasks/ is restricted to admins in app.yaml
+class SweepHandler(BaseHandler):
+  def post(self):
+    config = load_config()
+    if config is None:
+      return
+    if sweep_expired(config, datetime.now()):
+      taskqueue.add(url = '/tasks/sweep')
+    self.response.out.write("OK")
+
+  get = post
+
+# reserves the versions of the existing builds of a project batch by batch,
+# see schedule_version_reservation
+class ReserveVersionsHandler(BaseHandler):
+  def post(self):
+    project_key = self.request.get('project')
+    if reserve_existing_versions(project_key):
+      taskqueue.add(url = '/tasks/reserve-versions', params = dict(project = project_key))
+    self.response.out.write("OK")
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from builder.models import *
+from builder.console import console_positions
+from builder.dispatch import LONG_POLL_CHECK_INTERVAL
+
+# a page keeps a single request open for the live updates of all builds it shows
+# (see watch_list_info); the request waits on memcache only, until the project
+# revision moves (a build changed its state) or a watched console grows
+
+# returns the changed project revision and the watches whose console has news
+def pending_updates(project_key, watch_list):
+  revision = project_revision(project_key)
+  revision_changed = (revision is None or revision[0] != watch_list.revision)
+  watches = [watch for watch in watch_list.watches if watch.message_key is not None]
+  positions = console_positions([watch.message_key for watch in watches])
+  consoles = []
+  for watch in watches:
+    count, finished = positions[watch.message_key]
+    if finished or (count is not None and count > watch.offset):
+      consoles.append(watch)
+  return revision_changed, consoles
+
+def wait_for_updates(project_key, watch_list, deadline):
+  while True:
+    revision_changed, consoles = pending_updates(project_key, watch_list)
+    if revision_changed or consoles or time.time() >= deadline:
+      return revision_changed, consoles
+    time.sleep(min(LONG_POLL_CHECK_INTERVAL, max(0, deadline - time.time())))
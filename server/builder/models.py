@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
 import logging
+import hashlib
 from google.appengine.ext import db
 from google.appengine.api import memcache
+try:
+  from google.appengine.api import taskqueue
+except ImportError:
+  from google.appengine.api.labs import taskqueue
 from datetime import datetime, timedelta
 
 from yslib.dates import time_delta_in_words, delta_to_seconds
-from tabular import tabularize, untabularize
+from itertools import chain
+from tabular import tabularize, untabularize, iterlines, tabular_writer
 from builder.data.perproject import script_info
 from builder.data.chosen_repos import repo_configuration_info
+from builder.data.artifacts import artifact_index_info, report_info
+from builder.console import flushed_console_state, read_console_page
+from builder.caching import get_cached, set_cached, invalidate_cached
 
 def transaction(method):
   def decorate(*args, **kwds):
@@ -63,12 +72,19 @@ def id_or_name_of(key_or_model_or_id_or_name):
     return key_or_model_or_id_or_name
   raise "Illegal value passed to id_or_name_of: %s" % key_or_model_or_id_or_name
 
-def calculate_next_version(latest_build):
-  if latest_build is None:
+def index_report(report):
+  return untabularize(report_info(), report).index
+
+# returns None for versions not ending in a number (like 1.0-beta), which have no obvious successor
+def calculate_next_version(latest_version):
+  if latest_version is None:
     return '0.0.1'
   else:
-    v = latest_build.version.split('.')
-    v[-1] = str(int(v[-1]) + 1)
+    v = latest_version.split('.')
+    try:
+      v[-1] = str(int(v[-1]) + 1)
+    except ValueError:
+      return None
     return ".".join(v)
 
 class InstallationConfig(db.Model):
@@ -77,12 +93,27 @@ class InstallationConfig(db.Model):
   builder_offline_after = db.IntegerProperty(default = 120)
   builder_is_recent_within = db.IntegerProperty(default = 60*60*24)
   build_abandoned_after = db.IntegerProperty(default = 60*60)
+  # continuous builds wait this many seconds for more triggers to merge into them
+  continuous_debounce = db.IntegerProperty(default = 0)
   num_latest_builds = db.IntegerProperty(default = 3)
   num_recent_builds = db.IntegerProperty(default = 30)
   common_script = db.TextProperty(default = '')
 
 config_query = InstallationConfig.gql("LIMIT 1")
 
+CONFIG_CACHE_KEY = "installation-config"
+
+def load_config():
+  config = get_cached(CONFIG_CACHE_KEY)
+  if config is None:
+    config = config_query.get()
+    if config is not None:
+      set_cached(CONFIG_CACHE_KEY, config)
+  return config
+  
+def invalidate_config():
+  invalidate_cached(CONFIG_CACHE_KEY)
+
 ANONYMOUS_LEVEL = -1
 VIEWER_LEVEL    = 0
 NORMAL_LEVEL    = 1
@@ -97,6 +128,15 @@ level_names = {
   GOD_LEVEL: 'developer'
 }
 
+# builds that are not pinned to a builder are taken by any builder of their pool
+# that has all the required tags
+DEFAULT_POOL = 'default'
+# how many recently built projects a builder is assumed to have warm checkouts of
+WARM_PROJECTS = 10
+
+def parse_tags(s):
+  return sorted(set([tag.strip() for tag in (s or '').split(',') if tag.strip()]))
+
 class Builder(db.Model):
   name = db.StringProperty()
   created_at = db.DateTimeProperty(auto_now_add = True)
@@ -104,9 +144,23 @@ class Builder(db.Model):
   busy = db.BooleanProperty()
   progress = db.TextProperty()
   self_update_requested = db.BooleanProperty(default = False)
+  # reported by the builder itself on every poll
+  pool = db.StringProperty(default = DEFAULT_POOL)
+  tags = db.StringListProperty()
+  # most recently built first
+  warm_projects = db.ListProperty(db.Key)
+
+  def can_run(self, message):
+    return set(message.required_tags).issubset(self.tags)
+
+  def note_warm_project(self, project_key):
+    if project_key is not None:
+      self.warm_projects = ([project_key] + [key for key in self.warm_projects if key != project_key])[:WARM_PROJECTS]
 
-  def bind_environment(self, config, now):
-    self._since_last_check = delta_to_seconds(now - self.last_check_at)
+  def bind_environment(self, config, now, last_check_at = None):
+    if last_check_at is None or last_check_at < self.last_check_at:
+      last_check_at = self.last_check_at
+    self._since_last_check = delta_to_seconds(now - last_check_at)
     self._config = config
 
   def set_message_count(self, count):
@@ -131,6 +185,15 @@ class Project(db.Model):
   script_info_tab = db.TextProperty(default = '')
   continuous_builder = db.ReferenceProperty(Builder, collection_name = 'continuously_built_projects')
   continuous_token = db.StringProperty()
+  # continuous builds go to this pool when there is no continuous_builder
+  continuous_pool = db.StringProperty()
+  # builders taking builds of this project from a pool must have all these tags
+  required_tags = db.StringListProperty()
+  # the version of the latest build, kept together with BuildVersion reservations
+  last_version = db.StringProperty()
+  versions_reserved = db.BooleanProperty(default = False)
+  # where the reservation of existing builds continues, see reserve_existing_versions
+  reservation_cursor = db.TextProperty()
   
   def validate(self):  
     self.name = self.name.strip()
@@ -143,6 +206,9 @@ class Project(db.Model):
     
   def urlname(self):
     return "%s" % self.permalink
+
+  def has_continuous_builds(self):
+    return self.continuous_builder is not None or bool(self.continuous_pool)
     
   @staticmethod
   def by_urlname(permalink):
@@ -154,16 +220,10 @@ class Project(db.Model):
     return self._script_info
     
   def derive_info_from_script(self, common_script):
-    self._script_info = untabularize(script_info(), common_script + "\n" + self.script)
+    self._script_info = untabularize(script_info(), chain(iterlines(common_script), iterlines(self.script)))
     self._script_info.postprocess()
     self.script_info_tab = db.Text(tabularize(self._script_info))
     
-def split_tags(s):
-  if s == '-':
-    return []
-  else:
-    return s.split(',')
-    
 BUILD_ABANDONED = 0
 BUILD_SUCCEEDED = 1
 BUILD_FAILED = 2
@@ -171,6 +231,21 @@ BUILD_INPROGRESS = 3
 BUILD_QUEUED = 4
 BUILD_ABORTED = 5
     
+# higher priorities are dispatched first
+PRIORITY_BACKFILL = 0
+PRIORITY_CONTINUOUS = 1
+PRIORITY_MANUAL = 2
+
+priority_names = {
+  PRIORITY_BACKFILL: 'backfill',
+  PRIORITY_CONTINUOUS: 'continuous',
+  PRIORITY_MANUAL: 'manual',
+}
+
+# within a priority, the queued builds of one project are spaced this many seconds
+# apart, so that a burst of builds of one project cannot starve the other projects
+FAIR_SHARE_INTERVAL = 10*60
+
 state_info = {
   BUILD_ABANDONED:  dict(name = 'abandoned',  color = 'grey'),
   BUILD_INPROGRESS: dict(name = 'inprogress', color = 'blue'),
@@ -182,92 +257,111 @@ state_info = {
 
 class Build(db.Model):
   project = db.ReferenceProperty(Project, collection_name = 'builds')
+  # None until a builder of the pool takes the build
   builder = db.ReferenceProperty(Builder, collection_name = 'builds')
+  pool = db.StringProperty()
+  required_tags = db.StringListProperty()
+  priority = db.IntegerProperty(default = PRIORITY_MANUAL)
   state = db.IntegerProperty(default = BUILD_ABANDONED, choices = [BUILD_INPROGRESS, BUILD_QUEUED, BUILD_SUCCEEDED, BUILD_FAILED, BUILD_ABANDONED, BUILD_ABORTED])
   repo_configuration = db.TextProperty(default = '')
   version = db.StringProperty()
   report = db.TextProperty(default = '')
+  # featured public downloads parsed out of the report, see artifact_index_info
+  artifacts_tab = db.TextProperty(default = None)
   failure_reason = db.TextProperty(default = '')
   has_server_overrides = db.BooleanProperty(default = False)
   has_client_overrides = db.BooleanProperty(default = None)
   created_at = db.DateTimeProperty(auto_now_add = True)
   created_by = db.UserProperty()
+  # an in-progress build still running at this time gets abandoned by the sweeper
+  deadline_at = db.DateTimeProperty()
+  # continuous build requests merged into this build while it was queued
+  merged_triggers = db.IntegerProperty(default = 0)
+  # the last batch of report records appended while building
+  report_seq = db.IntegerProperty(default = 0)
+  # when a builder took the build and when the build ended up in a final state
+  dispatched_at = db.DateTimeProperty()
+  finished_at = db.DateTimeProperty()
+  # estimated from DurationStats when the build is dispatched
+  expected_finish_at = db.DateTimeProperty()
       
   def set_active_message(self, message):
     self._active_message = message
+    self._queue_position = None
+
+  def calculate_queue_position(self):
+    message = self._active_message
+    if self.state == BUILD_QUEUED and message is not None and message.state == MESSAGE_QUEUED:
+      self._queue_position = queue_position(message)
+
+  # 1-based, None unless the build is queued and calculate_queue_position has been called
+  def queue_position(self):
+    return getattr(self, '_queue_position', None)
+
+  # 'durations' are the DurationStats of the project, if any
+  def calculate_eta(self, now, durations):
+    self._eta = None
+    if self.state == BUILD_INPROGRESS and self.expected_finish_at is not None:
+      self._eta = self.expected_finish_at - now
+    elif self.state == BUILD_QUEUED and durations is not None and durations.run_times:
+      expected_start = max(now, self.created_at + timedelta(seconds = durations.mean_wait))
+      self._eta = expected_start + timedelta(seconds = durations.mean_run) - now
+
+  # the time left until the build is expected to finish (negative when overdue), or None
+  def eta(self):
+    return getattr(self, '_eta', None)
+
+  def is_overdue(self):
+    return self.eta() is not None and self.eta() < timedelta(0)
     
   def active_message(self):
     return self._active_message
 
   def calculate_derived_data(self):
-    stores = dict()
-    items = dict()
-    last_item = None
-    last_item_in_store = None
-    for line in self.report.split("\n"):
-      if len(line) == 0:
-        continue
-      command, args = line.split("\t", 1)
-      if command == 'STORE':
-        name, tags, description, rem = (args+"\t\t").split("\t", 3)
-        if description == '-' or description == '':
-          description = name
-        stores[name] = dict(name = name, tags = split_tags(tags), description = description, items = [])
-      elif command == 'ITEM':
-        kind, name, tags, description, rem = (args+"\t").split("\t", 4)
-        tags = split_tags(tags)
-        if kind != 'file' or not 'featured' in tags:
-          # skip this item
-          last_item_in_store = last_item = None
-          continue
-        if description == '-':
-          description = name
-        last_item = items[name] = dict(kind=kind, name=name, tags=tags, description=description)
-      elif command == 'INSTORE':
-        if last_item == None:
-          continue
-        name, rem = (args+"\t").split("\t", 1)
-        store = stores[name]
-        if not 'public' in store['tags']:
-          last_item_in_store = None
-          continue
-        last_item_in_store = dict(other_locations = [], **last_item)
-        store['items'].append(last_item_in_store)
-      elif command == 'ACCESS':
-        if last_item_in_store == None:
-          continue
-        kind, tags, path, rem = (args+"\t").split("\t", 3)
-        location = dict(kind=kind, tags=split_tags(tags), path=path)
-        if kind == 'url' and not last_item.has_key('url_location'):
-          last_item_in_store['url_location'] = location
-        else:
-          last_item_in_store['other_locations'].append(location)
-
-    self._stores = stores.values()
-    self._stores = filter(lambda store: len(store['items']) > 0, self._stores)
+    self._stores = [store for store in self.artifact_index().stores if store.items]
+    
+  def artifact_index(self):
+    if not hasattr(self, '_artifact_index'):
+      if self.artifacts_tab is None:
+        self._artifact_index = index_report(self.report)
+        if not self.is_queued_or_in_progress():
+          # builds reported before the index existed get it on the first view
+          self.artifacts_tab = db.Text(tabularize(self._artifact_index))
+          self.put()
+      else:
+        self._artifact_index = untabularize(artifact_index_info(), self.artifacts_tab)
+    return self._artifact_index
     
   def calculate_active_message(self):
+    self.set_active_message(None)
     if self.state in (BUILD_QUEUED, BUILD_INPROGRESS):
       active_message = self.messages.filter('state =', 1).get()
       if active_message is None:
         active_message = self.messages.filter('state =', 0).get()
       self.set_active_message(active_message)
     
-  def calculate_time_deltas(self, now):
-    self._since_start = (now - self.created_at)
+  def calculate_console(self, page_number = None):
+    self._console_page = None
+    self._console_pages = 0
+    message = self.messages.order('-created_at').get()
+    if message is None:
+      return
+    pages = message.console_pages or flushed_console_state(message.key())[1]
+    if pages == 0:
+      return
+    if page_number is None or not (1 <= page_number <= pages):
+      page_number = pages
+    self._console_page = read_console_page(message.key(), page_number)
+    self._console_pages = pages
     
-  def check_abandoning(self, build_abandoned_after):
-    if self.state == BUILD_INPROGRESS and self._since_start > timedelta(seconds = build_abandoned_after):
-      self.abandon_and_put()
-        
-  def abandon_and_put(self):
-    logging.info("Build(%s).abandon_and_put()" % self.version)
-    self.state = BUILD_ABANDONED
-    self.put()
+  def console_page(self):
+    return self._console_page
     
-    messages = self.messages.filter('state =', MESSAGE_INPROGRESS).fetch(100)
-    for message in messages:
-      message.abandon_and_put()
+  def console_pages(self):
+    return self._console_pages
+    
+  def calculate_time_deltas(self, now):
+    self._since_start = (now - self.created_at)
     
   def stores(self):
     return self._stores
@@ -283,6 +377,11 @@ class Build(db.Model):
 
   def state_color(self):
     return state_info[self.state]['color']
+
+  def target_name(self):
+    if Build.builder.get_value_for_datastore(self) is not None:
+      return self.builder.name
+    return "pool %s" % self.pool
     
   def failure_reason_summary(self):
     if len(self.failure_reason) == 0:
@@ -306,27 +405,541 @@ MESSAGE_ABORTED = 4
 class Message(db.Model):
   builder = db.ReferenceProperty(Builder, collection_name = 'messages')
   build = db.ReferenceProperty(Build, collection_name = 'messages')
+  project = db.ReferenceProperty(Project, collection_name = 'messages')
+  pool = db.StringProperty()
+  required_tags = db.StringListProperty()
   created_at = db.DateTimeProperty(auto_now_add = True)
   body = db.TextProperty()
   state = db.IntegerProperty(default = 0)
+  console_pages = db.IntegerProperty(default = 0)
+  deadline_at = db.DateTimeProperty()
+  # queued messages are dispatched by priority, then by scheduled_at
+  priority = db.IntegerProperty()
+  scheduled_at = db.DateTimeProperty()
+  # not dispatched before this time, see continuous_debounce
+  hold_until = db.DateTimeProperty()
+
+  def is_held(self, now):
+    return self.hold_until is not None and self.hold_until > now
   
-  def abandon_and_put(self):
-    logging.info("Message(%s).abandon_and_put()" % self.key())
-    self.state = MESSAGE_ABANDONED
-    self.put()
-    
-    key = "progress-%s" % (self.key())
-    memcache.set(key, "FIN", time = 60*60)
-    
+class ScriptRevision(db.Model):
+  # a script stored once no matter how many messages use it; the key name is
+  # "h<sha1 of the UTF-8 text>", and messages refer to it with an INCLUDE line
+  text = db.TextProperty()
+  created_at = db.DateTimeProperty(auto_now_add = True)
+
+  @staticmethod
+  def key_for(script_hash):
+    return "h%s" % script_hash
+
+def script_hash_of(text):
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def script_cache_key(script_hash):
+  return "script-%s" % script_hash
+
+# returns the hash to refer to the text by
+def store_script(text):
+  script_hash = script_hash_of(text)
+  if memcache.get(script_cache_key(script_hash)) is None:
+    ScriptRevision.get_or_insert(ScriptRevision.key_for(script_hash), text = db.Text(text))
+    memcache.set(script_cache_key(script_hash), text)
+  return script_hash
+
+# returns a dict of the texts of the scripts by hash; unknown hashes are left out
+def load_scripts(script_hashes):
+  result = memcache.get_multi([script_cache_key(h) for h in script_hashes])
+  result = dict([(h, result[script_cache_key(h)]) for h in script_hashes if script_cache_key(h) in result])
+  missing = [h for h in script_hashes if h not in result]
+  if missing:
+    revisions = ScriptRevision.get_by_key_name([ScriptRevision.key_for(h) for h in missing])
+    fetched = dict([(h, revision.text) for h, revision in zip(missing, revisions) if revision is not None])
+    memcache.set_multi(dict([(script_cache_key(h), text) for h, text in fetched.iteritems()]))
+    result.update(fetched)
+  return result
+
+INCLUDE_PREFIX = "INCLUDE\t"
+
+# replaces INCLUDE lines of a message body with the scripts they refer to,
+# for builders that cannot fetch scripts themselves
+def expand_includes(body):
+  lines = body.split("\n")
+  includes = [line[len(INCLUDE_PREFIX):].strip() for line in lines if line.startswith(INCLUDE_PREFIX)]
+  if not includes:
+    return body
+  scripts = load_scripts(includes)
+  result = []
+  for line in lines:
+    if line.startswith(INCLUDE_PREFIX):
+      script_hash = line[len(INCLUDE_PREFIX):].strip()
+      if script_hash in scripts:
+        result.append(scripts[script_hash])
+        continue
+      logging.error("Script %s referenced by a message is missing" % script_hash)
+    result.append(line)
+  return "\n".join(result)
+
+# a message body starts with the version of its build; the rest does not depend on it
+def versioned_message_body(version, body):
+  parts = []
+  tabular_writer(parts.append).row('SET', 'ver', version)
+  parts.append("\n")
+  parts.append(body)
+  return "".join(parts)
+
+class BuildVersion(db.Model):
+  # reserves a version number within a project; the parent is the Project
+  build = db.ReferenceProperty(Build, collection_name = 'version_reservations')
+  created_at = db.DateTimeProperty(auto_now_add = True)
+
+  @staticmethod
+  def key_for(version):
+    return "v%s" % version
+
+  @staticmethod
+  def get_for(project, version):
+    return BuildVersion.get_by_key_name(BuildVersion.key_for(version), parent = project)
+
+# how many builds a single reserve_existing_versions task reads
+RESERVATION_BATCH = 500
+# a reservation task chain that has not finished in this many seconds is started again
+RESERVATION_RESTART_AFTER = 10*60
+
+def reservation_scheduled_key(project_key):
+  return "reserving-%s" % project_key
+
+# projects with builds started before versions were reserved get their reservations
+# from a chain of /tasks/reserve-versions tasks; until the chain is done, start_build
+# checks versions with a query (see is_version_taken)
+def schedule_version_reservation(project):
+  if project.versions_reserved:
+    return
+  if memcache.add(reservation_scheduled_key(project.key()), True, time = RESERVATION_RESTART_AFTER):
+    taskqueue.add(url = '/tasks/reserve-versions', params = dict(project = str(project.key())))
+
+# reserves the versions of the next batch of builds, continuing from the cursor stored
+# in the project; returns True when there are more builds left
+def reserve_existing_versions(project_key):
+  project = Project.get(project_key)
+  if project is None or project.versions_reserved:
+    return False
+  builds, cursor = fetch_page(project.builds.order('created_at'), project.reservation_cursor, RESERVATION_BATCH)
+  reservations = [BuildVersion(parent = project, key_name = BuildVersion.key_for(build.version), build = build)
+    for build in builds]
+  for i in xrange(0, len(reservations), 100):
+    db.put(reservations[i:i+100])
+  if cursor is not None:
+    save_reservation_progress(project.key(), cursor, None)
+    return True
+  # the builds are read oldest first, so the last one is the latest
+  save_reservation_progress(project.key(), None, builds and builds[-1].version)
+  return False
+
+# 'latest_version' marks the reservations complete
+@transaction
+def save_reservation_progress(project_key, cursor, latest_version):
+  project = Project.get(project_key)
+  project.reservation_cursor = cursor
+  if cursor is None:
+    project.versions_reserved = True
+    # builds started meanwhile have set last_version already
+    if project.last_version is None:
+      project.last_version = latest_version
+  project.put()
+
+# the version of the latest build of the project
+def latest_version(project):
+  if project.versions_reserved:
+    return project.last_version
+  latest_build = project.builds.order('-created_at').get()
+  return latest_build and latest_build.version
+
+# only needed until the reservations of the project are complete; create_build
+# checks the reservations itself
+def is_version_taken(project, version):
+  if project.versions_reserved:
+    return False
+  return project.builds.filter('version =', version).count(1) > 0
+
+# returns None if the version is already taken
+@transaction
+def create_build(project_key, version, priority, build_values, message_values):
+  if BuildVersion.get_for(project_key, version) is not None:
+    return None
+  project = Project.get(project_key)
+  # fair share: a build is scheduled after the builds of the project still queued with the
+  # same priority, so dispatched builds and the other priorities do not push it back
+  scheduled_at = datetime.now()
+  queue_tail = Message.all().ancestor(project_key).filter('state =', MESSAGE_QUEUED).filter(
+    'priority =', priority).order('-scheduled_at').get()
+  if queue_tail is not None and queue_tail.scheduled_at is not None:
+    scheduled_at = max(scheduled_at, queue_tail.scheduled_at + timedelta(seconds = FAIR_SHARE_INTERVAL))
+  build = Build(parent = project_key, project = project_key, version = version, priority = priority, **build_values)
+  build.put()
+  message = Message(parent = build, build = build, project = project_key, priority = priority,
+    scheduled_at = scheduled_at, **message_values)
+  BuildVersion(parent = project_key, key_name = BuildVersion.key_for(version), build = build).put()
+  message.put()
+  project.last_version = version
+  project.put()
+  return build
+
+# however many triggers keep arriving, a continuous build is held at most this many
+# debounce intervals after it was first queued
+CONTINUOUS_MAX_HOLD = 4
+
+def continuous_hold_until(config, now, first_queued_at = None):
+  if not config.continuous_debounce:
+    return None
+  hold_until = now + timedelta(seconds = config.continuous_debounce)
+  if first_queued_at is not None:
+    hold_until = min(hold_until, first_queued_at + timedelta(seconds = config.continuous_debounce * CONTINUOUS_MAX_HOLD))
+  return hold_until
+
+# the queued message is checked within the project's entity group, where builders
+# claim it too, so a trigger never merges into a build that is already being built;
+# 'body' is the message body without the version (see versioned_message_body)
+@transaction
+def merge_into_queued_continuous_build(project_key, repo_configuration_str, body, config, now):
+  build = Build.all().ancestor(project_key).filter('state =', BUILD_QUEUED).filter('priority =', PRIORITY_CONTINUOUS).get()
+  if build is None:
+    return None
+  message = Message.all().ancestor(build).filter('state =', MESSAGE_QUEUED).get()
+  if message is None:
+    return None
+  message.body = versioned_message_body(build.version, body)
+  message.hold_until = continuous_hold_until(config, now, message.created_at)
+  message.put()
+  build.repo_configuration = repo_configuration_str
+  build.merged_triggers = (build.merged_triggers or 0) + 1
+  build.put()
+  return build
+
+# the queue of a message is its builder, or the name of its pool until a builder takes it
+def queue_of(message):
+  return Message.builder.get_value_for_datastore(message) or message.pool
+
+class QueueDepth(db.Model):
+  # the number of queued messages of a builder or a pool, see adjust_queue_depth
+  depth = db.IntegerProperty(default = 0)
+
+  @staticmethod
+  def key_for(queue):
+    if isinstance(queue, basestring):
+      return "p%s" % queue
+    return "b%s" % id_or_name_of(queue)
+
+# must be called after the message itself has been stored
+def adjust_queue_depth(queue, delta):
+  if not update_queue_depth(QueueDepth.key_for(queue), delta):
+    initialize_queue_depth(queue)
+
+@transaction
+def update_queue_depth(key_name, delta):
+  counter = QueueDepth.get_by_key_name(key_name)
+  if counter is None:
+    return False
+  counter.depth = max(0, counter.depth + delta)
+  counter.put()
+  return True
+  
+# counters are created from the real number of messages the first time they are needed
+def initialize_queue_depth(queue):
+  depth = queued_messages(queue, keys_only = True).count(1000)
+  counter = QueueDepth(key_name = QueueDepth.key_for(queue), depth = depth)
+  counter.put()
+  return counter
+
+def fetch_queue_depths(queues):
+  keys = [db.Key.from_path('QueueDepth', QueueDepth.key_for(queue)) for queue in queues]
+  result = []
+  for queue, counter in zip(queues, db.get(keys)):
+    if counter is None:
+      counter = initialize_queue_depth(queue)
+    result.append(counter.depth)
+  return result
+
+# a page of the queued messages of the pool in dispatch order; returns (messages, cursor
+# of the next page or None)
+def pool_candidates(pool, cursor, limit):
+  return fetch_page(queued_messages(pool).order('-priority').order('scheduled_at'), cursor, limit)
+
+def queued_messages(queue, keys_only = False):
+  if isinstance(queue, basestring):
+    query = Message.all(keys_only = keys_only).filter('pool =', queue).filter('builder =', None)
+  else:
+    query = Message.all(keys_only = keys_only).filter('builder =', queue)
+  return query.filter('state =', MESSAGE_QUEUED)
+
+# the next messages pinned to the builder, in dispatch order
+def builder_candidates(builder, limit):
+  messages = queued_messages(builder.key()).order('-priority').order('scheduled_at').fetch(limit)
+  if not messages:
+    # messages queued before priorities existed are missing from the index used above
+    messages = [message for message in queued_messages(builder.key()).order('created_at').fetch(limit)
+      if message.scheduled_at is None]
+  return messages
+
+# the 1-based position of a queued message in its queue
+def queue_position(message):
+  if message.priority is None or message.scheduled_at is None:
+    return None
+  queue = queue_of(message)
+  ahead = queued_messages(queue, keys_only = True).filter('priority >', message.priority).count(1000)
+  ahead += queued_messages(queue, keys_only = True).filter('priority =', message.priority).filter(
+    'scheduled_at <', message.scheduled_at).count(1000)
+  return ahead + 1
+
+# atomically hands the message over to the builder; returns None if it has been taken
+# by another builder (or aborted) in the meantime
+@transaction
+def claim_message(message_key, builder_key, deadline_at):
+  message = Message.get(message_key)
+  if message is None or message.state != MESSAGE_QUEUED:
+    return None
+  if Message.builder.get_value_for_datastore(message) not in (None, builder_key):
+    return None
+  message.builder = builder_key
+  message.state = MESSAGE_INPROGRESS
+  message.deadline_at = deadline_at
+  message.put()
+  return message
+
+# rolling queue wait and run time statistics of the latest ROLLUP_SAMPLES finished builds
+# of a project or of a builder, updated as every build finishes; a builder's builds wait
+# in many queues, so only its run times are kept
+ROLLUP_SAMPLES = 20
+
+class DurationStats(db.Model):
+  # in seconds, oldest first
+  queue_waits = db.ListProperty(int)
+  run_times = db.ListProperty(int)
+  mean_wait = db.IntegerProperty(default = 0)
+  p90_wait = db.IntegerProperty(default = 0)
+  mean_run = db.IntegerProperty(default = 0)
+  p90_run = db.IntegerProperty(default = 0)
+  updated_at = db.DateTimeProperty(auto_now = True)
+
+  @staticmethod
+  def key_for(subject_key):
+    return "%s%s" % (subject_key.kind()[0].lower(), id_or_name_of(subject_key))
+
+  def add_sample(self, wait, run):
+    if wait is not None:
+      self.queue_waits = (self.queue_waits + [wait])[-ROLLUP_SAMPLES:]
+      self.mean_wait, self.p90_wait = mean_and_p90(self.queue_waits)
+    self.run_times = (self.run_times + [run])[-ROLLUP_SAMPLES:]
+    self.mean_run, self.p90_run = mean_and_p90(self.run_times)
+
+def mean_and_p90(samples):
+  ordered = sorted(samples)
+  return sum(ordered) / len(ordered), ordered[min(len(ordered) - 1, len(ordered) * 9 / 10)]
+
+@transaction
+def add_duration_sample(subject_key, wait, run):
+  key_name = DurationStats.key_for(subject_key)
+  stats = DurationStats.get_by_key_name(key_name) or DurationStats(key_name = key_name)
+  stats.add_sample(wait, run)
+  stats.put()
+
+# called once a build has finished by itself; aborted and abandoned builds say nothing
+# about how long a build takes
+def record_build_durations(build):
+  if build.dispatched_at is None or build.finished_at is None:
+    return
+  wait = delta_to_seconds(build.dispatched_at - build.created_at)
+  run = delta_to_seconds(build.finished_at - build.dispatched_at)
+  add_duration_sample(Build.project.get_value_for_datastore(build), wait, run)
+  builder_key = Build.builder.get_value_for_datastore(build)
+  if builder_key is not None:
+    add_duration_sample(builder_key, None, run)
+
+# returns the DurationStats of the given projects or builders, None where there are none yet
+def load_duration_stats(*subject_keys):
+  return DurationStats.get_by_key_name([DurationStats.key_for(key) for key in subject_keys])
+
+class ProjectDashboard(db.Model):
+  # everything the project page lists, recalculated on every build and message state change
+  project = db.ReferenceProperty(Project, collection_name = 'dashboards')
+  num_latest_builds = db.IntegerProperty()
+  num_recent_builds = db.IntegerProperty()
+  latest_builds = db.ListProperty(db.Key)
+  recent_builds = db.ListProperty(db.Key)
+  successful_builds = db.ListProperty(db.Key)
+  # active_messages[i] is the message currently carrying active_builds[i]
+  active_builds = db.ListProperty(db.Key)
+  active_messages = db.ListProperty(db.Key)
+  next_version = db.StringProperty()
+  revision = db.IntegerProperty(default = 0)
+  updated_at = db.DateTimeProperty(auto_now = True)
+
+  @staticmethod
+  def key_for(project):
+    return "k%s" % id_or_name_of(project)
+
+  def is_stale_for(self, config):
+    return (self.num_latest_builds != config.num_latest_builds or
+      self.num_recent_builds != config.num_recent_builds)
+
+  def all_keys(self):
+    return self.latest_builds + self.recent_builds + self.successful_builds + self.active_messages
+
+  def active_message_of(self, build_key):
+    try:
+      return self.active_messages[self.active_builds.index(build_key)]
+    except ValueError:
+      return None
+
+def refresh_dashboard(project_key, config = None):
+  if config is None:
+    config = load_config() or InstallationConfig()
+  project_key = db.Key(str(project_key))
+  num_latest = config.num_latest_builds
+  num_recent = config.num_recent_builds
+  
+  builds = Build.all().filter('project =', project_key).order('-created_at').fetch(max(num_latest, num_recent))
+  successful_builds = Build.all().filter('project =', project_key).filter('state =', BUILD_SUCCEEDED).order('-created_at').fetch(num_recent)
+  active_builds = []
+  active_messages = []
+  for build in builds[0:num_latest]:
+    build.calculate_active_message()
+    if build.active_message():
+      active_builds.append(build.key())
+      active_messages.append(build.active_message().key())
+  
+  values = dict(
+    num_latest_builds = num_latest,
+    num_recent_builds = num_recent,
+    latest_builds = [build.key() for build in builds[0:num_latest]],
+    recent_builds = [build.key() for build in builds[0:num_recent] if build.state != BUILD_SUCCEEDED],
+    successful_builds = [build.key() for build in successful_builds],
+    active_builds = active_builds,
+    active_messages = active_messages,
+    next_version = calculate_next_version(builds[0].version if builds else None),
+  )
+  dashboard = save_dashboard(project_key, values)
+  note_project_revision(project_key, dashboard)
+  return dashboard
+
+# for the builder protocol, which must not fail just because a page could not be refreshed;
+# the dashboard is dropped instead, so that the next page view rebuilds it
+def refresh_dashboard_quietly(project_key, config = None):
+  try:
+    return refresh_dashboard(project_key, config)
+  except Exception:
+    logging.exception("Cannot refresh the dashboard of project %s" % project_key)
+    try:
+      db.delete(db.Key.from_path('ProjectDashboard', ProjectDashboard.key_for(db.Key(str(project_key)))))
+    except Exception:
+      logging.exception("Cannot drop the dashboard of project %s" % project_key)
+    return None
+
+@transaction
+def save_dashboard(project_key, values):
+  key_name = ProjectDashboard.key_for(project_key)
+  dashboard = ProjectDashboard.get_by_key_name(key_name)
+  if dashboard is None:
+    dashboard = ProjectDashboard(key_name = key_name, project = project_key)
+  for k, v in values.iteritems():
+    setattr(dashboard, k, v)
+  dashboard.revision += 1
+  dashboard.put()
+  return dashboard
+
+def load_dashboard(project, config):
+  dashboard = ProjectDashboard.get_by_key_name(ProjectDashboard.key_for(project))
+  if dashboard is None or dashboard.is_stale_for(config):
+    dashboard = refresh_dashboard(project.key(), config)
+  return dashboard
+
+# the dashboard revision doubles as the change counter of a project: it is bumped on every
+# build and message state change and on every edit of the project. It is mirrored in memcache
+# together with what is needed to check access, so that a status poll of an unchanged project
+# can be answered without touching the datastore.
+def project_stub_key(permalink):
+  return "projectstub-%s" % permalink
+
+def project_revision_key(project_key):
+  return "projectrev-%s" % project_key
+
+# returns dict(key, is_public) or None if there is no such project
+def project_stub(permalink):
+  stub = get_cached(project_stub_key(permalink))
+  if stub is None:
+    project = Project.by_urlname(permalink)
+    if project is None:
+      return None
+    stub = dict(key = str(project.key()), is_public = project.is_public)
+    set_cached(project_stub_key(permalink), stub)
+  return stub
+
+def invalidate_project_stub(*permalinks):
+  invalidate_cached(*[project_stub_key(permalink) for permalink in permalinks])
+
+def note_project_revision(project_key, dashboard):
+  memcache.set(project_revision_key(project_key), (dashboard.revision, dashboard.updated_at))
+
+# returns (revision, updated_at) or None if the project has no dashboard yet
+def project_revision(project_key):
+  revision = memcache.get(project_revision_key(project_key))
+  if revision is None:
+    dashboard = ProjectDashboard.get_by_key_name(ProjectDashboard.key_for(db.Key(str(project_key))))
+    if dashboard is None:
+      return None
+    note_project_revision(project_key, dashboard)
+    revision = (dashboard.revision, dashboard.updated_at)
+  return revision
+
+# replaces the given reference property of every entity with a batch-fetched value
+def prefetch_references(entities, prop):
+  keys = set([prop.get_value_for_datastore(entity) for entity in entities])
+  keys.discard(None)
+  keys = list(keys)
+  fetched = dict(zip(keys, db.get(keys)))
+  for entity in entities:
+    key = prop.get_value_for_datastore(entity)
+    if key is not None and fetched.get(key) is not None:
+      setattr(entity, prop.name, fetched[key])
+
+# the long lists (build history, projects, people) are shown in pages of a fixed size,
+# so that showing a page costs the same however many entities there are
+HISTORY_PAGE_SIZE = 30
+PROJECTS_PAGE_SIZE = 50
+PROFILES_PAGE_SIZE = 50
+
+# returns the page of the query that starts at 'cursor' and the cursor of the next page,
+# or None if this is the last one (a full last page is followed by an empty one)
+def fetch_page(query, cursor, size):
+  if cursor:
+    query.with_cursor(cursor)
+  entities = query.fetch(size)
+  if len(entities) < size:
+    return entities, None
+  return entities, query.cursor()
+
+def build_history_query(project, state = None, builder = None):
+  query = Build.all().filter('project =', project)
+  if state is not None:
+    query.filter('state =', state)
+  if builder is not None:
+    query.filter('builder =', builder)
+  return query.order('-created_at')
+
 class Profile(db.Model):
   user = db.UserProperty()
   email = db.EmailProperty()
   level = db.IntegerProperty(default = NORMAL_LEVEL, choices = [ANONYMOUS_LEVEL, VIEWER_LEVEL, NORMAL_LEVEL, ADMIN_LEVEL, GOD_LEVEL])
   last_used_builder = db.ReferenceProperty(Builder, collection_name = 'last_used_by')
+  last_used_pool = db.StringProperty()
 
   def level_name(self):
     return level_names[self.level]
 
+  @staticmethod
+  def cache_key_for(email):
+    # profiles are cached by email because invited people have no user yet
+    return "profile-%s" % email
+
   def urlname(self):
     return self.email
 
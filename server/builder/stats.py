@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import webapp
+
+# every request is measured (wall time, time spent in the prolog and in template
+# rendering, datastore and memcache calls) and added to memcache counters of its
+# route, i.e. handler class and method. The counters are kept per STATS_WINDOW
+# and expire after STATS_WINDOWS windows, so /stats shows a rolling last hour.
+# Wall times go into a histogram with the bucket bounds below, which gives the
+# percentiles to within a bucket.
+STATS_WINDOW = 10*60
+STATS_WINDOWS = 6
+WALL_BUCKETS = [10, 20, 50, 100, 200, 300, 500, 1000, 2000, 5000, 10000, 30000]
+COUNTERS = ['requests', 'wall_ms', 'prolog_ms', 'render_ms', 'datastore_gets', 'datastore_puts',
+  'datastore_queries', 'memcache_hits', 'memcache_misses']
+
+BUCKET_COUNTERS = ["le%d" % bound for bound in WALL_BUCKETS] + ['over']
+ALL_COUNTERS = COUNTERS + BUCKET_COUNTERS
+
+DATASTORE_COUNTERS = {
+  'Get': 'datastore_gets',
+  'Put': 'datastore_puts',
+  'RunQuery': 'datastore_queries',
+  'Query': 'datastore_queries',
+  'Count': 'datastore_queries',
+}
+
+# the routes that may show up on /stats, see instrumented
+known_routes = []
+
+class request_stats(object):
+  def __init__(self):
+    self.route = None
+    self.started_at = time.time()
+    self.counters = dict()
+
+  def add(self, name, amount = 1):
+    self.counters[name] = self.counters.get(name, 0) + amount
+
+_current = None
+# the (window, route) pairs whose counters this instance has created
+_initialized_windows = set()
+
+def begin_request():
+  global _current
+  _current = request_stats()
+
+def name_request(handler_name, method):
+  if _current is not None:
+    _current.route = route_name(handler_name, method)
+
+def route_name(handler_name, method):
+  return "%s.%s" % (handler_name, method.lower())
+
+def note_time(name, started_at):
+  if _current is not None:
+    _current.add(name, int((time.time() - started_at) * 1000))
+
+def end_request():
+  global _current
+  stats, _current = _current, None
+  if stats is None or stats.route is None:
+    return
+  wall_ms = int((time.time() - stats.started_at) * 1000)
+  stats.add('requests')
+  stats.add('wall_ms', wall_ms)
+  stats.add(bucket_name(wall_ms))
+  window = current_window()
+  try:
+    if (window, stats.route) not in _initialized_windows:
+      # counters created by offset_multi would never expire
+      memcache.add_multi(dict([(stats_key(window, stats.route, name), 0) for name in ALL_COUNTERS]),
+        time = STATS_WINDOW * (STATS_WINDOWS + 1))
+      for pair in [pair for pair in _initialized_windows if pair[0] < window]:
+        _initialized_windows.discard(pair)
+      _initialized_windows.add((window, stats.route))
+    memcache.offset_multi(dict([(stats_key(window, stats.route, name), value)
+      for name, value in stats.counters.iteritems() if value]), initial_value = 0)
+  except Exception, e:
+    # statistics must never break the request they describe
+    logging.warning("cannot record the stats of %s: %s" % (stats.route, e))
+
+def count_api_call(service, call, request, response, *rem):
+  stats = _current
+  if stats is None:
+    return
+  if service == 'datastore_v3':
+    counter = DATASTORE_COUNTERS.get(call)
+    if counter is not None:
+      stats.add(counter)
+  elif service == 'memcache' and call == 'Get':
+    hits = response.item_size()
+    stats.add('memcache_hits', hits)
+    stats.add('memcache_misses', request.key_size() - hits)
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('builder-stats', count_api_call)
+
+def current_window():
+  return int(time.time()) // STATS_WINDOW
+
+def stats_key(window, route, name):
+  return "stats-%d-%s-%s" % (window, route, name)
+
+def bucket_name(wall_ms):
+  for bound in WALL_BUCKETS:
+    if wall_ms <= bound:
+      return "le%d" % bound
+  return "over"
+
+# wraps the WSGI application; the routes are the handler methods of url_mapping
+class instrumented(object):
+  def __init__(self, application, url_mapping):
+    self.application = application
+    routes = set()
+    for pattern, handler in url_mapping:
+      for method in ('get', 'post'):
+        if getattr(handler, method).im_func is not getattr(webapp.RequestHandler, method).im_func:
+          routes.add(route_name(handler.__name__, method))
+    known_routes[:] = sorted(routes)
+
+  def __call__(self, environ, start_response):
+    begin_request()
+    try:
+      return self.application(environ, start_response)
+    finally:
+      end_request()
+
+# wall time percentile in ms from a histogram; None when over the largest bucket
+def percentile(buckets, requests, fraction):
+  if requests == 0:
+    return None
+  seen = 0
+  for bound, count in buckets:
+    seen += count
+    if seen >= fraction * requests:
+      return bound
+  return None
+
+class route_stats(object):
+  def __init__(self, route, values):
+    self.route = route
+    for name in COUNTERS:
+      setattr(self, name, values.get(name, 0))
+    buckets = [(bound, values.get("le%d" % bound, 0)) for bound in WALL_BUCKETS]
+    self.p50 = percentile(buckets, self.requests, 0.50)
+    self.p95 = percentile(buckets, self.requests, 0.95)
+    self.p99 = percentile(buckets, self.requests, 0.99)
+
+  def per_request(self, name):
+    return float(getattr(self, name)) / max(1, self.requests)
+
+  def mean_wall_ms(self):
+    return int(self.per_request('wall_ms'))
+
+  def mean_prolog_ms(self):
+    return int(self.per_request('prolog_ms'))
+
+  def mean_render_ms(self):
+    return int(self.per_request('render_ms'))
+
+  def gets_per_request(self):
+    return "%.1f" % self.per_request('datastore_gets')
+
+  def puts_per_request(self):
+    return "%.1f" % self.per_request('datastore_puts')
+
+  def queries_per_request(self):
+    return "%.1f" % self.per_request('datastore_queries')
+
+  def memcache_hit_rate(self):
+    lookups = self.memcache_hits + self.memcache_misses
+    if lookups == 0:
+      return u'—'
+    return "%d%%" % int(100.0 * self.memcache_hits / lookups)
+
+# the stats of the last STATS_WINDOWS windows, busiest routes first
+def load_stats():
+  window = current_window()
+  windows = range(window - STATS_WINDOWS + 1, window + 1)
+  keys = [stats_key(w, route, name) for route in known_routes for w in windows for name in ALL_COUNTERS]
+  values = dict()
+  for start in range(0, len(keys), 1000):
+    values.update(memcache.get_multi(keys[start:start + 1000]))
+  result = []
+  for route in known_routes:
+    totals = dict([(name, sum([values.get(stats_key(w, route, name), 0) for w in windows])) for name in ALL_COUNTERS])
+    if totals['requests'] > 0:
+      result.append(route_stats(route, totals))
+  result.sort(lambda a, b: cmp(b.wall_ms, a.wall_ms))
+  return result
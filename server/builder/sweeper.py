@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from datetime import datetime, timedelta
+from google.appengine.ext import db
+
+from builder.models import *
+from builder.transitions import abandon_builds, abandon_messages
+
+# builds and messages handled per sweep request; a full batch schedules another sweep
+SWEEP_BATCH = 50
+
+def expired(klass, state, now, limit):
+  return klass.all().filter('state =', state).filter('deadline_at <', now).order('deadline_at').fetch(limit)
+
+# entities that went in progress before deadlines were recorded get one based on created_at;
+# those written before the property existed have no index entry for it at all, so they
+# cannot be queried for and every entity in the state is looked at instead
+def assign_missing_deadlines(klass, state, config, limit):
+  assigned = 0
+  cursor = None
+  while True:
+    entities, cursor = fetch_page(klass.all().filter('state =', state), cursor, limit)
+    missing = [entity for entity in entities if entity.deadline_at is None]
+    for entity in missing:
+      entity.deadline_at = entity.created_at + timedelta(seconds = config.build_abandoned_after)
+    db.put(missing)
+    assigned += len(missing)
+    if cursor is None:
+      return assigned
+
+# abandons the builds and messages whose deadline has passed;
+# returns True if there may be more left than a single batch
+def sweep_expired(config, now, limit = SWEEP_BATCH):
+  assigned = assign_missing_deadlines(Build, BUILD_INPROGRESS, config, limit)
+  assigned += assign_missing_deadlines(Message, MESSAGE_INPROGRESS, config, limit)
+
+  builds = expired(Build, BUILD_INPROGRESS, now, limit)
+  abandon_builds(builds, config)
+
+  messages = expired(Message, MESSAGE_INPROGRESS, now, limit)
+  abandon_messages(messages, config)
+
+  logging.info("sweeper set %d missing deadline(s), abandoned %d build(s) and %d message(s)" % (assigned, len(builds), len(messages)))
+  return len(builds) == limit or len(messages) == limit
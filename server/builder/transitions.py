@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from datetime import datetime
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from builder.models import *
+from builder.console import finish_consoles
+from builder.dispatch import note_work_changed, note_pool_work_changed
+
+# state changes of builds and messages are applied to whole sets of entities at once:
+# every entity group is read and written in a single transaction, and the memcache
+# and counter bookkeeping that follows is batched as well
+
+BUILD_FINAL_STATES = (BUILD_FAILED, BUILD_SUCCEEDED, BUILD_ABANDONED, BUILD_ABORTED)
+MESSAGE_FINAL_STATES = (MESSAGE_DONE, MESSAGE_ABANDONED, MESSAGE_ABORTED)
+
+MESSAGES_PER_BUILD = 100
+
+def message_control_key(message_key):
+  return "control-%s" % message_key
+
+class state_change(object):
+  # moves the entity to 'state' unless it is already in one of 'final_states';
+  # 'values' are set on the entity along with the state
+  def __init__(self, key, state, final_states, **values):
+    self.key = key
+    self.state = state
+    self.final_states = final_states
+    self.values = values
+    self.entity = None
+    self.previous_state = None
+
+def entity_group_of(key):
+  while key.parent() is not None:
+    key = key.parent()
+  return key
+
+# returns the changes that took effect, with 'entity' and 'previous_state' filled in
+def apply_state_changes(changes):
+  groups = {}
+  for change in changes:
+    groups.setdefault(entity_group_of(change.key), []).append(change)
+  applied = []
+  for group in groups.itervalues():
+    applied += db.run_in_transaction(apply_state_changes_to_group, group)
+  return applied
+
+def apply_state_changes_to_group(changes):
+  applied = []
+  for change, entity in zip(changes, db.get([change.key for change in changes])):
+    if entity is None or entity.state in change.final_states:
+      continue
+    change.entity = entity
+    change.previous_state = entity.state
+    entity.state = change.state
+    for name, value in change.values.iteritems():
+      setattr(entity, name, value)
+    applied.append(change)
+  if applied:
+    db.put([change.entity for change in applied])
+  return applied
+
+def abort_builds(builds, config = None):
+  return transition_builds(builds, BUILD_ABORTED, MESSAGE_ABORTED, (MESSAGE_INPROGRESS, MESSAGE_QUEUED), config)
+
+def abandon_builds(builds, config = None):
+  return transition_builds(builds, BUILD_ABANDONED, MESSAGE_ABANDONED, (MESSAGE_INPROGRESS,), config)
+
+def abandon_messages(messages, config = None):
+  return transition_messages(messages, MESSAGE_ABANDONED, [], config)
+
+# the unfinished messages of the builds (those in 'message_states') go along with them
+def transition_builds(builds, build_state, message_state, message_states, config = None):
+  messages = []
+  for build in builds:
+    for state in message_states:
+      messages += build.messages.filter('state =', state).fetch(MESSAGES_PER_BUILD)
+  now = datetime.now()
+  build_changes = [state_change(build.key(), build_state, BUILD_FINAL_STATES, finished_at = now) for build in builds]
+  return transition_messages(messages, message_state, build_changes, config)
+
+def transition_messages(messages, state, other_changes, config = None):
+  # the consoles are closed first so that the page counts can be stored with the new state
+  pages = finish_consoles([message.key() for message in messages])
+  changes = other_changes + [state_change(message.key(), state, MESSAGE_FINAL_STATES,
+    console_pages = pages[str(message.key())]) for message in messages]
+  applied = apply_state_changes(changes)
+  after_state_changes(applied, config)
+  return applied
+
+def after_state_changes(applied, config = None):
+  builds = dict([(change.key, change.entity) for change in applied if isinstance(change.entity, Build)])
+  messages = [change.entity for change in applied if isinstance(change.entity, Message)]
+  logging.info("state changes applied to %d build(s) and %d message(s)" % (len(builds), len(messages)))
+  if messages:
+    memcache.delete_multi([message_control_key(message.key()) for message in messages])
+
+  # messages that were still queued leave the queues of their builders or pools
+  dequeued = {}
+  for change in applied:
+    if isinstance(change.entity, Message) and change.previous_state == MESSAGE_QUEUED:
+      queue = queue_of(change.entity)
+      dequeued[queue] = dequeued.get(queue, 0) + 1
+  for queue, count in dequeued.iteritems():
+    adjust_queue_depth(queue, -count)
+  pools = [queue for queue in dequeued.iterkeys() if isinstance(queue, basestring)]
+  builder_keys = [queue for queue in dequeued.iterkeys() if not isinstance(queue, basestring)]
+  if builder_keys:
+    note_work_changed(*[builder.name for builder in db.get(builder_keys) if builder is not None])
+  note_pool_work_changed(*pools)
+
+  build_keys = set([Message.build.get_value_for_datastore(message) for message in messages]) - set(builds.keys())
+  if build_keys:
+    for build in db.get(list(build_keys)):
+      if build is not None:
+        builds[build.key()] = build
+  for project_key in set([Build.project.get_value_for_datastore(build) for build in builds.itervalues()]):
+    refresh_dashboard_quietly(project_key, config)
+
+def request_self_update(builders):
+  for builder in builders:
+    builder.self_update_requested = True
+  db.put(builders)
+  note_work_changed(*[builder.name for builder in builders])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import zlib
+
+# builders may send gzip- or deflate-encoded request bodies and receive gzipped responses;
+# inflated request bodies are limited to stay well below what a request may carry anyway
+MAX_INFLATED_SIZE = 8*1024*1024
+# smaller responses are not worth compressing
+MIN_COMPRESSED_SIZE = 512
+
+class TransportError(Exception):
+  def __init__(self, code, message):
+    Exception.__init__(self, message)
+    self.code = code
+
+def inflate(data, encoding):
+  if encoding == 'gzip':
+    decompressors = [zlib.decompressobj(16 + zlib.MAX_WBITS)]
+  else:
+    # 'deflate' is zlib-wrapped by the spec, but raw deflate is common in the wild
+    decompressors = [zlib.decompressobj(), zlib.decompressobj(-zlib.MAX_WBITS)]
+  for decompressor in decompressors:
+    try:
+      result = decompressor.decompress(data, MAX_INFLATED_SIZE + 1)
+    except zlib.error:
+      continue
+    if len(result) > MAX_INFLATED_SIZE or decompressor.unconsumed_tail:
+      raise TransportError(413, "Request body inflates to more than %d bytes" % MAX_INFLATED_SIZE)
+    return result + decompressor.flush()
+  raise TransportError(400, "Cannot decode %s request body" % encoding)
+
+def gzip(data):
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+def accepts_gzip(request):
+  return 'gzip' in [part.split(';')[0].strip() for part in request.headers.get('Accept-Encoding', '').split(',')]
+
+# replaces a compressed request body with the inflated one; returns (wire size, inflated size)
+def inflate_request(request):
+  encoding = request.headers.get('Content-Encoding', '').strip().lower()
+  body = request.body
+  if encoding not in ('gzip', 'deflate'):
+    return len(body), len(body)
+  inflated = inflate(body, encoding)
+  del request.headers['Content-Encoding']
+  request.body = inflated
+  return len(body), len(inflated)
+
+# returns (plain size, wire size)
+def deflate_response(request, response):
+  body = response.out.getvalue()
+  response.headers['Vary'] = 'Accept-Encoding'
+  if len(body) < MIN_COMPRESSED_SIZE or not accepts_gzip(request):
+    return len(body), len(body)
+  if isinstance(body, unicode):
+    body = body.encode('utf-8')
+  compressed = gzip(body)
+  response.out.seek(0)
+  response.out.truncate()
+  response.out.write(compressed)
+  response.headers['Content-Encoding'] = 'gzip'
+  return len(body), len(compressed)
+
+def ratio(plain, wire):
+  if wire == 0:
+    return 1.0
+  return float(plain) / wire
+
+# decorates the handler methods of the builder protocol
+def compressed_transport(method):
+  def decoration(self, *args):
+    try:
+      request_wire, request_plain = inflate_request(self.request)
+    except TransportError, e:
+      logging.warning("%d: %s" % (e.code, e))
+      self.error(e.code)
+      return
+    result = method(self, *args)
+    response_plain, response_wire = deflate_response(self.request, self.response)
+    logging.info("transport %s: request %d -> %d bytes (%.1fx), response %d -> %d bytes (%.1fx)" % (
+      self.request.path, request_wire, request_plain, ratio(request_plain, request_wire),
+      response_plain, response_wire, ratio(response_plain, response_wire)))
+    return result
+  decoration.__name__ = method.__name__
+  decoration.__dict__ = method.__dict__
+  decoration.__doc__  = method.__doc__
+  return decoration
@@ -6,10 +6,13 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 
 from builder.handlers.index import IndexHandler, ProjectsHandler
 from builder.handlers.people import PeopleHandler, CrudePersonHandler
-from builder.handlers.project import CreateEditProjectHandler, ProjectHandler, DeleteProjectHandler
+from builder.handlers.project import CreateEditProjectHandler, ProjectHandler, ProjectHistoryHandler, ProjectUpdatesHandler, DeleteProjectHandler
 from builder.handlers.build import ProjectBuildHandler, BuildProjectHandler, StartContinuousBuildProjectHandler, AbortProjectBuildHandler
-from builder.handlers.build import BuilderObtainWorkHandler, BuilderMessageDoneHandler, ReportProgressHandler, MessageConsoleHandler
-from builder.handlers.server import SelfUpdateRequestHandler, ServerConfigHandler
+from builder.handlers.build import BuilderObtainWorkHandler, BuilderMessageDoneHandler, BuilderReportHandler, ReportProgressHandler, MessageConsoleHandler, ScriptHandler
+from builder.handlers.server import SelfUpdateRequestHandler, ServerConfigHandler, StatsHandler
+from builder.handlers.tasks import SweepHandler, ReserveVersionsHandler
+from builder.stats import instrumented
+from builder.handlers.api import ApiProjectsHandler, ApiProjectHandler, ApiProjectBuildHandler, ApiProjectQueueHandler, ApiBuildersHandler
     
 url_mapping = [
   ('/', IndexHandler),
@@ -21,6 +24,8 @@ url_mapping = [
   ('/projects/(new)', CreateEditProjectHandler),
   ('/projects/([^/]*)', ProjectHandler),
   ('/projects/([^/]*)/edit', CreateEditProjectHandler),
+  ('/projects/([^/]*)/history', ProjectHistoryHandler),
+  ('/projects/([^/]*)/updates', ProjectUpdatesHandler),
   ('/projects/([^/]*)/delete', DeleteProjectHandler),
   ('/projects/([^/]*)/build', BuildProjectHandler),
   ('/projects/([^/]*)/start_continuous_build', StartContinuousBuildProjectHandler),
@@ -29,11 +34,23 @@ url_mapping = [
   
   ('/builders/([^/]*)/obtain-work', BuilderObtainWorkHandler),
   ('/builders/([^/]*)/messages/([^/]*)/done', BuilderMessageDoneHandler),
+  ('/builders/([^/]*)/messages/([^/]*)/report', BuilderReportHandler),
   ('/messages/([^/]*)/report_progress', ReportProgressHandler),
   ('/messages/([^/]*)/console', MessageConsoleHandler),
+  ('/scripts/([0-9a-f]+)', ScriptHandler),
   ('/server-config', ServerConfigHandler),
+  ('/stats', StatsHandler),
+  
+  ('/api/projects', ApiProjectsHandler),
+  ('/api/projects/([^/]*)', ApiProjectHandler),
+  ('/api/projects/([^/]*)/queue', ApiProjectQueueHandler),
+  ('/api/projects/([^/]*)/builds/([^/]*)', ApiProjectBuildHandler),
+  ('/api/builders', ApiBuildersHandler),
+  
+  ('/tasks/sweep', SweepHandler),
+  ('/tasks/reserve-versions', ReserveVersionsHandler),
 ]
-application = webapp.WSGIApplication(url_mapping, debug=True)
+application = instrumented(webapp.WSGIApplication(url_mapping, debug=True), url_mapping)
 
 def main():
   run_wsgi_app(application)
@@ -1,7 +1,7 @@
 
 import os
 from google.appengine.ext.webapp import template
-from yslib.dates import time_delta_in_words
+from yslib.dates import time_delta_in_words, duration_in_words
 
 template_path = os.path.join(os.path.dirname(__file__), 'templates')
 
@@ -14,5 +14,8 @@ def timedelta(delta):
 @register.filter
 def revtimedelta(delta):
   return time_delta_in_words(-delta)
+@register.filter
+def duration(delta):
+  return duration_in_words(delta)
   
 # register.filter(time_delta_in_words)
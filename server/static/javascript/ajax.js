@@ -23,6 +23,29 @@ function ajax(url, vars, callbackFunction) {
   return request;
 };
 
+function ajax_form(url, vars, callbackFunction, failedFunction) {
+  var request =  new XMLHttpRequest();
+  request.open("POST", url, true);
+  request.setRequestHeader("Content-Type", "application/x-www-form-urlencoded");
+
+  request.onreadystatechange = function() {
+    if (request.readyState != 4)
+      return;
+    if (request.status == 200)
+      callbackFunction(request.responseText);
+    else
+      failedFunction();
+  };
+  request.send(vars);
+  return request;
+};
+
+function parse_json(text) {
+  if (typeof JSON != "undefined")
+    return JSON.parse(text);
+  return eval("(" + text + ")");
+};
+
 function $A(iterable) {
   if (!iterable) return [];
   if (iterable.toArray) return iterable.toArray();
@@ -194,6 +217,136 @@ function periodically_update(options) {
   });
 }
 
+// a single long-polling channel per page, carrying the console output and the state
+// changes of all builds shown; a build whose state changes gets its fragment
+// (the container element) replaced in place, which registers it again if still running
+YourSway.LiveUpdates = function(options) {
+  this.url = options.url;
+  this.revision = options.revision;
+  this.watches = {};
+  this.request = null;
+  this.watchdog = null;
+  this.scheduled = false;
+  this.timeout = options.timeout || 30000;
+  this.retry_period = options.retry_period || 5000;
+};
+
+// build, state, message, fragment, container, output
+YourSway.LiveUpdates.prototype.watch = function(watch) {
+  watch.offset = 0;
+  this.watches[watch.build] = watch;
+  if (!this.scheduled && this.request == null)
+    this.schedule(false, 100);
+};
+
+YourSway.LiveUpdates.prototype.schedule = function(wait, delay) {
+  this.scheduled = true;
+  window.setTimeout(this.poll.bind(this, wait), delay);
+};
+
+YourSway.LiveUpdates.prototype.poll = function(wait) {
+  this.scheduled = false;
+  var lines = ["REVISION\t" + this.revision];
+  for (var key in this.watches) {
+    var w = this.watches[key];
+    lines.push(["WATCH", w.build, w.state, w.message || "-", w.offset, w.fragment || "-"].join("\t"));
+  }
+  if (lines.length == 1)
+    return;
+  var vars = "watch=" + encodeURIComponent(lines.join("\n")) + (wait ? "&wait=1" : "");
+  var request_id = this.request_id = {};
+  this.request = ajax_form(this.url, vars,
+    this.received.bind(this, request_id), this.failed.bind(this, request_id));
+  this.watchdog = window.setTimeout(this.expired.bind(this, request_id), this.timeout);
+};
+
+YourSway.LiveUpdates.prototype.finished = function(request_id) {
+  if (request_id != this.request_id)
+    return false;
+  this.request_id = null;
+  this.request = null;
+  window.clearTimeout(this.watchdog);
+  this.watchdog = null;
+  return true;
+};
+
+YourSway.LiveUpdates.prototype.received = function(request_id, text) {
+  if (!this.finished(request_id))
+    return;
+  var response = parse_json(text);
+  if (response.revision != null)
+    this.revision = response.revision;
+  // scheduled first, so that the builds registered by replaced fragments join the next poll
+  this.schedule(true, 100);
+  for (var i = 0; i < response.builds.length; i++)
+    this.apply(response.builds[i]);
+};
+
+YourSway.LiveUpdates.prototype.failed = function(request_id) {
+  if (!this.finished(request_id))
+    return;
+  this.schedule(true, this.retry_period);
+};
+
+YourSway.LiveUpdates.prototype.expired = function(request_id) {
+  var request = this.request;
+  if (!this.finished(request_id))
+    return;
+  request.abort();
+  this.schedule(true, this.retry_period);
+};
+
+YourSway.LiveUpdates.prototype.apply = function(update) {
+  var w = this.watches[update.build];
+  if (!w)
+    return;
+  if (update.mode) {
+    w.offset = update.offset;
+    this.append_console(w, update);
+  }
+  if (update.state) {
+    w.state = update.state;
+    if (update.html != null) {
+      delete this.watches[w.build];
+      $(w.container).innerHTML = update.html.stripScripts();
+      update.html.evalScripts();
+    }
+  }
+};
+
+YourSway.LiveUpdates.prototype.append_console = function(w, delta) {
+  var div = $(w.output);
+  if (delta.mode == 'FIN') {
+    // the new state of the build follows with the next revision
+    w.message = null;
+  }
+  if (!div)
+    return;
+  if (delta.mode == 'WAIT') {
+    if (div.innerHTML == '')
+      div.innerHTML = "Waiting for log from the builder...";
+    return;
+  }
+  if (delta.mode == 'R' || div.innerHTML == "Waiting for log from the builder...")
+    div.innerHTML = '';
+  if (delta.text == '')
+    return;
+  div.innerHTML += delta.text;
+  div.scrollTop = div.scrollHeight;
+};
+
+YourSway.live = null;
+
+// url, revision
+function live_updates(options) {
+  YourSway.live = new YourSway.LiveUpdates(options);
+}
+
+function watch_build(watch) {
+  if (YourSway.live)
+    YourSway.live.watch(watch);
+}
+
 function log(msg) {
   l = $('log');
   if(l)
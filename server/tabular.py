@@ -1,46 +1,147 @@
+from cStringIO import StringIO as byte_stream
+try:
+  from io import StringIO as text_stream
+except ImportError:
+  text_stream = None
 
-def tabularize(receiver):
-  array = []
-  receiver.tabularize(array)
-  return "\n".join(map(lambda row: "\t".join(row), array))
-    
+class tabular_writer(object):
+  # passes rows to 'write' (e.g. file.write or list.append) as soon as they are produced
+
+  def __init__(self, write):
+    self.write = write
+    self.empty = True
+
+  def row(self, *fields):
+    self.append(fields)
+
+  def subrow(self, *fields):
+    self.append(('',) + fields)
+
+  # list-compatible, so receivers may treat the writer as an array of rows
+  def append(self, fields):
+    self.text("\t".join([self.escape(field) for field in fields]))
+
+  # adds a block of already tabularized text, e.g. a script
+  def text(self, text):
+    if self.empty:
+      self.empty = False
+    else:
+      self.write("\n")
+    self.write(text)
+
+  # the builder splits rows on raw tabs and line breaks and has no way to unescape
+  # them, so any that slip into a field (say, a report summary) become spaces
+  def escape(self, field):
+    if field is None:
+      return '-'
+    if not isinstance(field, basestring):
+      field = unicode(field)
+    if "\t" in field or "\n" in field or "\r" in field:
+      field = field.replace("\r\n", " ").replace("\t", " ").replace("\n", " ").replace("\r", " ")
+    return field
+
+# returns the text unless 'write' is given
+def tabularize(receiver, write = None):
+  if write is not None:
+    receiver.tabularize(tabular_writer(write))
+    return None
+  parts = []
+  receiver.tabularize(tabular_writer(parts.append))
+  return "".join(parts)
+
+class dispatch_table(object):
+  # handlers of a receiver class, looked up once per command and then reused;
+  # commands maps a command to its (on_<command>, after_<command>) pair
+
+  def __init__(self, klass):
+    self.klass = klass
+    self.commands = {}
+    self.subcommands = {}
+
+  def command(self, command):
+    handlers = self.commands[command] = (getattr(self.klass, "on_%s" % command, None),
+      getattr(self.klass, "after_%s" % command, None))
+    return handlers
+
+  def subcommand(self, command, subcommand):
+    handler = self.subcommands[(command, subcommand)] = getattr(self.klass, "on_%s_%s" % (command, subcommand), None)
+    return handler
+
+_dispatch_tables = {}
+
+def dispatch_table_for(klass):
+  try:
+    return _dispatch_tables[klass]
+  except KeyError:
+    table = _dispatch_tables[klass] = dispatch_table(klass)
+    return table
+
+# iterates over the lines of a string without splitting it into a list first;
+# the lines may keep their trailing newline
+def iterlines(text):
+  if isinstance(text, str):
+    return byte_stream(text)
+  if text_stream is not None:
+    return text_stream(text)
+  return _iterlines(text)
+
+def _iterlines(text):
+  start = 0
+  while True:
+    end = text.find("\n", start)
+    if end < 0:
+      yield text[start:]
+      return
+    yield text[start:end]
+    start = end + 1
+
+# script is either a string or any iterable of lines (e.g. a file)
 def untabularize(receiver, script, *root_context_args):
+  if isinstance(script, basestring):
+    script = iterlines(script)
+  table = dispatch_table_for(receiver.__class__)
+  commands = table.commands
+  subcommands = table.subcommands
+  after = None
   prev_command = None
   context_args = ()
-  for line in script.split("\n"):
-    stripped = line.strip()
-    if len(stripped) == 0 or stripped.startswith('#'):
+  for line in script:
+    if line.endswith("\n"):
+      line = line[:-1]
+    stripped = line.lstrip()
+    if len(stripped) == 0 or stripped[0] == '#':
       continue
     fields = line.split("\t")
     if len(fields[0]) == 0:
-      command, args = fields[1].lower(), fields[2:]
-      handler_name = "on_%s_%s" % (prev_command, command)
-      
-      if hasattr(receiver, handler_name):
-        getattr(receiver, handler_name)(*(context_args + tuple(args)))
-      
+      key = (prev_command, fields[1].lower())
+      try:
+        handler = subcommands[key]
+      except KeyError:
+        handler = table.subcommand(*key)
+      if handler is not None:
+        fields[0:2] = context_args
+        handler(receiver, *fields)
+
     else:
-      if prev_command:
-        handler_name = "after_%s" % prev_command
-        if hasattr(receiver, handler_name):
-          getattr(receiver, handler_name)(*context_args)
-      
-      command, args = fields[0].lower(), fields[1:]
-      handler_name = "on_%s" % command
-      prev_command = command
-      
-      if not hasattr(receiver, handler_name):
+      if after is not None:
+        after(receiver, *context_args)
+
+      command = prev_command = fields[0].lower()
+      try:
+        handler, after = commands[command]
+      except KeyError:
+        handler, after = table.command(command)
+      if handler is None:
         continue
-      context_args = (getattr(receiver, handler_name)(*(root_context_args + tuple(args))) or [])
+      fields[0:1] = root_context_args
+      context_args = (handler(receiver, *fields) or ())
       if context_args and not (type(context_args) is tuple):
         if type(context_args) is list:
           context_args = tuple(context_args)
         else:
           context_args = (context_args,)
-    
-  if prev_command:
-    handler_name = "after_%s" % prev_command
-    if hasattr(receiver, handler_name):
-      getattr(receiver, handler_name)(*context_args)
-      
+
+  if after is not None:
+    after(receiver, *context_args)
+
   return receiver
@@ -76,6 +76,14 @@ future_delta_rule = choose_rule(
   format_rule(varying_string("in %d years", "in one year"), maximum = None, divisor = 60*60*24*365),
 )
 
+duration_rule = choose_rule(
+  format_rule("a few seconds", maximum = 10),
+  format_rule("less than a minute", maximum = 60),
+  format_rule(varying_string("%d minutes", "one minute"), maximum = 55, divisor = 60),
+  format_rule(varying_string("%d hours", "one hour"), maximum = 23, divisor = 60*60),
+  format_rule(varying_string("%d days", "one day"), maximum = None, divisor = 60*60*24),
+)
+
 def delta_to_seconds(seconds_or_delta):
   if hasattr(seconds_or_delta, 'days'):
     return seconds_or_delta.days * 24 * 60 * 60 + seconds_or_delta.seconds
@@ -91,6 +99,9 @@ def time_delta_in_words(seconds_or_delta):
   else:
     return future_delta_rule % seconds
 
+def duration_in_words(seconds_or_delta):
+  return duration_rule % abs(delta_to_seconds(seconds_or_delta))
+
 def test():
   from datetime import timedelta
   